@@ -1,13 +1,21 @@
 import pickle5 as pickle
+import numpy as np
 import pandas as pd
 import zipfile
 import os
+import shutil
+import struct
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
 from sephora_cn_recommendation_engine.lib.logger.logger_manager import LoggerManager
 from logging import Logger
 import functools
 import operator
 from datetime import date
 
+from bds_data_science.lib.common.date_utils import DATE_CACHE_SIZE, is_array_like, parse_dates, shift_yearmonth
+
 __compression_level: dict = {
     'STORED': zipfile.ZIP_STORED,
     'DEFLATED': zipfile.ZIP_DEFLATED,
@@ -90,36 +98,91 @@ cvr_ueop_features_dtype: dict = {
 
 common_logger: Logger = LoggerManager(logger_name="COMMON", log_level="INFO").logger
 
+# Header of the pickle files whose large buffers are stored out-of-band in pickle_file_path + BUFFER_FILE_SUFFIX
+OUT_OF_BAND_MAGIC = b'BDSOOB01'
+BUFFER_FILE_SUFFIX = '.buffers'
+BUFFER_ALIGNMENT = 64
+
 
-def deserialize_object(pickle_file_path: str):
+def deserialize_object(pickle_file_path: str, mmap: bool = True):
     """
     This function is used to deserialize a python pickle file.
+    The out-of-band buffers of a pickle written with serialize_object(..., out_of_band=True) are memory-mapped
+    copy-on-write, so the arrays are loaded lazily and their pages are shared across processes.
 
     :param pickle_file_path: File path of the pickle
+    :param mmap: Memory-map the out-of-band buffers, else read them into memory
     :return: python object else None
     """
     try:
         common_logger.info("Deserialization of the pickle file {}...".format(pickle_file_path))
         with open(pickle_file_path, "rb") as pickle_file:
-            object_deserialized = pickle.load(pickle_file)
+            if pickle_file.read(len(OUT_OF_BAND_MAGIC)) != OUT_OF_BAND_MAGIC:
+                pickle_file.seek(0)
+                return pickle.load(pickle_file)
+            spans = pickle.load(pickle_file)
+            buffer_file_path = pickle_file_path + BUFFER_FILE_SUFFIX
+            if not spans:
+                raw = np.empty(0, dtype=np.uint8)
+            elif mmap:
+                raw = np.memmap(buffer_file_path, dtype=np.uint8, mode='c')
+            else:
+                raw = np.fromfile(buffer_file_path, dtype=np.uint8)
+            object_deserialized = pickle.load(pickle_file, buffers=[raw[start:end] for start, end in spans])
         return object_deserialized
     except Exception as e:
         common_logger.error(e)
         return None
 
 
-def serialize_object(data, pickle_file_path: str, protocol: int = 4):
+def _serialize_out_of_band(data, pickle_file_path: str, min_buffer_size: int):
+    """
+    Pickle with protocol 5, the contiguous buffers of at least min_buffer_size bytes (numpy arrays, hence CSR
+    matrices and DataFrames) are written aligned into the side file instead of the pickle. The pickle file holds
+    the header, the (start, end) span of each buffer in the side file and then the pickle of the data.
+    """
+    buffers = []
+
+    def buffer_callback(buffer):
+        if buffer.raw().nbytes < min_buffer_size:
+            return True
+        buffers.append(buffer)
+        return False
+
+    pickled = pickle.dumps(data, protocol=5, buffer_callback=buffer_callback)
+    spans = []
+    with open(pickle_file_path + BUFFER_FILE_SUFFIX, "wb") as buffer_file:
+        for buffer in buffers:
+            start = buffer_file.tell()
+            padding = -start % BUFFER_ALIGNMENT
+            buffer_file.write(b'\0' * padding)
+            raw = buffer.raw()
+            buffer_file.write(raw)
+            spans.append((start + padding, start + padding + raw.nbytes))
+    with open(pickle_file_path, "wb") as pickle_file:
+        pickle_file.write(OUT_OF_BAND_MAGIC)
+        pickle.dump(spans, pickle_file, protocol=5)
+        pickle_file.write(pickled)
+
+
+def serialize_object(data, pickle_file_path: str, protocol: int = 4, out_of_band: bool = False,
+                     min_buffer_size: int = 1 << 16):
     """
     This function is used to serialize object as python pickle file
 
     :param data: Python object to serialize
     :param pickle_file_path: File path of the pickle
     :param protocol: Protocol number
+    :param out_of_band: Use protocol 5 and store the large buffers in the side file pickle_file_path + '.buffers',
+                        which deserialize_object memory-maps
+    :param min_buffer_size: Minimum number of bytes of a buffer stored out-of-band
     :return: True if the pickle has been created with success else False
     """
     try:
         common_logger.info("Serialization of the pickle file {}...".format(pickle_file_path))
-        if isinstance(data, pd.DataFrame):
+        if out_of_band:
+            _serialize_out_of_band(data, pickle_file_path, min_buffer_size)
+        elif isinstance(data, pd.DataFrame):
             data.to_pickle(pickle_file_path, protocol=protocol)
         else:
             with open(pickle_file_path, "wb") as pickle_file:
@@ -178,6 +241,143 @@ def unzip_file(file, directory, remove_zip_file: bool = True):
         return False
 
 
+def _zip_member(args):
+    """
+    Compress one file into its own single member zip file, run in a worker process
+    """
+    file_to_zip, arcname, member_zip_name, compression, compresslevel = args
+    with zipfile.ZipFile(member_zip_name, mode='w', compression=__compression_level[compression],
+                         compresslevel=compresslevel) as zf:
+        zf.write(file_to_zip, arcname)
+    return member_zip_name
+
+
+def _append_member(zf: zipfile.ZipFile, member_zip_name: str, chunk_size: int = 1 << 24):
+    """
+    Copy the compressed member of a single member zip file into an open zip file without decompressing it
+    """
+    with zipfile.ZipFile(member_zip_name, 'r') as src:
+        info = src.infolist()[0]
+        src.fp.seek(info.header_offset)
+        local_header = src.fp.read(30)
+        name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+        remaining = name_length + extra_length + info.compress_size
+        info.header_offset = zf.fp.tell()
+        zf.fp.write(local_header)
+        while remaining > 0:
+            chunk = src.fp.read(min(chunk_size, remaining))
+            zf.fp.write(chunk)
+            remaining -= len(chunk)
+    # The central directory is written by ZipFile.close from filelist
+    zf.filelist.append(info)
+    zf.NameToInfo[info.filename] = info
+    zf.start_dir = zf.fp.tell()
+
+
+def zip_files(files_to_zip: list, zip_file_name, arcnames: list = None, compression: str = "DEFLATED",
+              compresslevel: int = None, workers: int = None):
+    """
+    This function will compress many files as one zip file in parallel, each member is compressed by a worker
+    process and then copied as it is into the zip file
+
+    :param files_to_zip: Files to be zipped
+    :param zip_file_name: Name of the zip file
+    :param arcnames: Names of the files in the archive, the base names of the files by default
+    :param compression: Compression mode of the files as STORED, DEFLATED, BZIP2 and LZMA
+    :param compresslevel: Compression level, 0-9 for DEFLATED and 1-9 for BZIP2, None for the default level
+    :param workers: Number of worker processes, the number of CPUs by default
+
+    :return: Name of the zip file if success else None
+    """
+    if arcnames is None:
+        arcnames = [os.path.basename(x) for x in files_to_zip]
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(zip_file_name)))
+    try:
+        common_logger.info("Zipping {} files to {} using compression {}...".format(len(files_to_zip),
+                                                                                   zip_file_name,
+                                                                                   compression))
+        tasks = [(x, arcname, os.path.join(tmp_dir, '{}.zip'.format(i)), compression, compresslevel)
+                 for i, (x, arcname) in enumerate(zip(files_to_zip, arcnames))]
+        with ProcessPoolExecutor(workers) as executor, zipfile.ZipFile(zip_file_name, mode='w') as zf:
+            for member_zip_name in executor.map(_zip_member, tasks):
+                _append_member(zf, member_zip_name)
+                os.remove(member_zip_name)
+        return zip_file_name
+    except Exception as e:
+        common_logger.error(e)
+        return None
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def open_zip_member(file, member):
+    """
+    Open a member of a zip file as a binary stream, without extracting it
+
+    :param file: Zip file
+    :param member: Name of the member
+    :return: file object, to be closed by the caller
+    """
+    zf = zipfile.ZipFile(file, "r")
+    stream = zf.open(member)
+    # The archive is closed with the last of its open members
+    zf.close()
+    return stream
+
+
+def read_zip_member(file, member, **kwargs):
+    """
+    Read a member of a zip file directly into pandas or numpy, according to its extension:
+    .csv/.txt/.tsv by pd.read_csv, .parquet by pd.read_parquet, .pkl by pd.read_pickle, .npy by numpy and others
+    as bytes
+
+    :param file: Zip file
+    :param member: Name of the member
+    :param kwargs: Other arguments of the reader
+    :return: DataFrame, numpy array or bytes
+    """
+    ext = os.path.splitext(member)[1].lower()
+    with open_zip_member(file, member) as stream:
+        if ext in ('.csv', '.txt', '.tsv'):
+            return pd.read_csv(stream, **kwargs)
+        if ext == '.parquet':
+            return pd.read_parquet(stream, **kwargs)
+        if ext == '.pkl':
+            return pd.read_pickle(stream, **kwargs)
+        if ext == '.npy':
+            return np.lib.format.read_array(stream, **kwargs)
+        return stream.read()
+
+
+def zip_benchmark(files_to_zip: list, compressions=("STORED", "DEFLATED", "BZIP2", "LZMA"), compresslevel=None,
+                  workers: int = None, zip_file_name: str = None):
+    """
+    Compare the throughput and the compression ratio of the compression modes on some files
+
+    :param files_to_zip: Files to be zipped, e.g. our typical feature files
+    :param compressions: Compression modes to compare
+    :param compresslevel: Compression level
+    :param workers: Number of worker processes
+    :param zip_file_name: Name of the temporary zip file
+    :return: DataFrame of (compression, seconds, mb_per_second, ratio) with ratio = original size / zipped size
+    """
+    zip_file_name = zip_file_name or os.path.join(tempfile.gettempdir(), 'zip_benchmark.zip')
+    size = sum(os.path.getsize(x) for x in files_to_zip)
+    ret = []
+    try:
+        for compression in compressions:
+            start = time.time()
+            if zip_files(files_to_zip, zip_file_name, compression=compression, compresslevel=compresslevel,
+                         workers=workers) is None:
+                raise RuntimeError('Failed to zip with compression {}'.format(compression))
+            seconds = time.time() - start
+            ret.append((compression, seconds, size / 2 ** 20 / seconds, size / os.path.getsize(zip_file_name)))
+    finally:
+        if os.path.exists(zip_file_name):
+            os.remove(zip_file_name)
+    return pd.DataFrame(ret, columns=['compression', 'seconds', 'mb_per_second', 'ratio'])
+
+
 def flat(list_of_list):
     """
     This function will flat a list of list
@@ -202,9 +402,17 @@ def to_date_form(d):
     Support string and int
     String form: YYYYMMDD or YYYY-MM-DD or YYYY.M/MM.D/DD or YYYY/MM/DD[YYYY/M/D]
     Int form: YYYYMMDD
+    A Series or an array is parsed at once into datetime64, see date_utils.parse_dates
     :param d: string or int to transform
     :return: date
     """
+    if is_array_like(d):
+        return parse_dates(d)
+    return _to_date_form(d)
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE, typed=True)
+def _to_date_form(d):
     if d is None:
         return None
     d = str(d)
@@ -221,11 +429,32 @@ def to_date_form(d):
         return date(int(d[0:4]), int(d[4:6]), int(d[6:8]))
 
 
-def get_last_month(yearmonth):
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE, typed=True)
+def _shift_month(yearmonth, months):
     """
-    :param yearmonth: string/int, year+month, e.g.: 20181/201801
+    Zero-padded yearmonth of the input type, months later
+    """
+    ym = str(yearmonth)
+    year, month = divmod(int(ym[0:4]) * 12 + int(ym[4:]) - 1 + months, 12)
+    ret = year * 100 + month + 1
+    return ret if isinstance(yearmonth, int) else str(ret)
+
+
+def get_last_month(yearmonth, compat=True):
+    """
+    :param yearmonth: string/int, year+month, e.g.: 20181/201801, or a Series or array of them
+    :param compat: return an unpadded string as always, e.g. '20181', else a zero-padded yearmonth of the input type
     :return: the yearmonth of last month
     """
+    if is_array_like(yearmonth):
+        return shift_yearmonth(yearmonth, -1, compat)
+    if not compat:
+        return _shift_month(yearmonth, -1)
+    return _get_last_month(yearmonth)
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE, typed=True)
+def _get_last_month(yearmonth):
     if isinstance(yearmonth, int):
         yearmonth = str(yearmonth)
     year = int(yearmonth[0:4])
@@ -241,11 +470,21 @@ def get_last_month(yearmonth):
         return ret
 
 
-def get_next_month(yearmonth):
+def get_next_month(yearmonth, compat=True):
     """
-    :param yearmonth: string/int, year+month, e.g.: 20181/201801
-    :return: the yearmonth of last month
+    :param yearmonth: string/int, year+month, e.g.: 20181/201801, or a Series or array of them
+    :param compat: return an unpadded string as always, e.g. '20191', else a zero-padded yearmonth of the input type
+    :return: the yearmonth of next month
     """
+    if is_array_like(yearmonth):
+        return shift_yearmonth(yearmonth, 1, compat)
+    if not compat:
+        return _shift_month(yearmonth, 1)
+    return _get_next_month(yearmonth)
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE, typed=True)
+def _get_next_month(yearmonth):
     if isinstance(yearmonth, int):
         yearmonth = str(yearmonth)
     year = int(yearmonth[0:4])
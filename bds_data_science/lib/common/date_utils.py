@@ -1,4 +1,100 @@
 import datetime
+import functools
+
+import numpy as np
+import pandas as pd
+
+# Maximum number of memoized scalar calls of each date function
+DATE_CACHE_SIZE = 4096
+DATE_SEPARATORS = ('-', '.', '/')
+
+
+def is_array_like(x):
+    return isinstance(x, (pd.Series, pd.Index, np.ndarray))
+
+
+def _wrap(ret: pd.Series, like):
+    """
+    Return a Series for a Series input, else an ndarray
+    """
+    return ret if isinstance(like, pd.Series) else ret.to_numpy()
+
+
+def detect_date_format(value):
+    """
+    Detect the format of a date, e.g. the first valid value of a column
+    :param value: string or int, YYYYMMDD or YYYY-MM-DD or YYYY.M/MM.D/DD or YYYY/MM/DD[YYYY/M/D]
+    :return: the separator, '' for YYYYMMDD
+    """
+    value = str(value)
+    for sep in DATE_SEPARATORS:
+        if sep in value:
+            return sep
+    return ''
+
+
+def parse_dates(values, sep: str = None):
+    """
+    Vectorized version of common.to_date_form, the format is detected once from the first valid value
+    :param values: Series or array of strings or ints, all in the same format
+    :param sep: separator of the dates, '' for YYYYMMDD, detected by default
+    :return: datetime64[ns] Series with the index of values if it is a Series, else ndarray, missing values as NaT
+    """
+    s = values if isinstance(values, pd.Series) else pd.Series(values)
+    valid = s.notna().to_numpy()
+    ret = pd.Series(pd.NaT, index=s.index, dtype='datetime64[ns]')
+    if not valid.any():
+        return _wrap(ret, values)
+    s = s[valid]
+    if pd.api.types.is_numeric_dtype(s):
+        # YYYYMMDD ints, or floats for an int column with missing values
+        ymd = s.to_numpy().astype(np.int64)
+        dates = pd.to_datetime(pd.DataFrame({'year': ymd // 10000, 'month': ymd // 100 % 100, 'day': ymd % 100}))
+        ret[valid] = dates.to_numpy()
+        return _wrap(ret, values)
+    if sep is None:
+        sep = detect_date_format(s.iloc[0])
+    if sep:
+        dates = pd.to_datetime(s.astype(str), format='%Y{0}%m{0}%d'.format(sep))
+    else:
+        dates = pd.to_datetime(s.astype(str).str[:8], format='%Y%m%d')
+    ret[valid] = dates.to_numpy()
+    return _wrap(ret, values)
+
+
+def shift_yearmonth(values, months: int, compat=True):
+    """
+    Vectorized month arithmetic on yearmonths, see common.get_last_month and common.get_next_month
+    :param values: Series or array of yearmonths as strings or ints, e.g.: 20181/201801
+    :param months: number of months to add
+    :param compat: return unpadded strings like the scalar functions, e.g. '20181', else zero-padded yearmonths of
+                   the input type, e.g. 201801
+    :return: Series with the index of values if it is a Series, else ndarray
+    """
+    s = values if isinstance(values, pd.Series) else pd.Series(values)
+    if pd.api.types.is_numeric_dtype(s):
+        ym = s.to_numpy().astype(np.int64)
+        # The month of the unpadded yearmonths like 20181 has one digit
+        padded = ym >= 100000
+        year, month = np.where(padded, ym // 100, ym // 10), np.where(padded, ym % 100, ym % 10)
+    else:
+        s = s.astype(str)
+        year, month = s.str[:4].astype(np.int64).to_numpy(), s.str[4:].astype(np.int64).to_numpy()
+    year, month = np.divmod(year * 12 + month - 1 + months, 12)
+    month += 1
+    if compat:
+        ret = np.where(month >= 10, year * 100 + month, year * 10 + month).astype(str).astype(object)
+    else:
+        ret = year * 100 + month
+        if not pd.api.types.is_numeric_dtype(s):
+            ret = ret.astype(str).astype(object)
+    return _wrap(pd.Series(ret, index=s.index), values)
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE, typed=True)
+def _get_date_by_gap(end_date: str, day_gap: int):
+    return datetime.datetime.strftime(
+        datetime.datetime.strptime(end_date, '%Y-%m-%d') + datetime.timedelta(days=-day_gap + 1), '%Y-%m-%d')
 
 
 def get_date_by_gap(end_date: str, day_gap: int):
@@ -6,13 +102,15 @@ def get_date_by_gap(end_date: str, day_gap: int):
     This function is going to figure out the start date of data time period
 
     :param day_gap:
-    :param end_date:
+    :param end_date: YYYY-MM-DD, or a Series or array of them
     :param gap:
-    :return: start_date: str
+    :return: start_date: str, or a Series or array of them
     """
-    start_date = datetime.datetime.strftime(
-        datetime.datetime.strptime(end_date, '%Y-%m-%d') + datetime.timedelta(days=-day_gap + 1), '%Y-%m-%d')
-    return start_date
+    if is_array_like(end_date):
+        dates = parse_dates(end_date if isinstance(end_date, pd.Series) else pd.Series(end_date), sep='-')
+        ret = (dates - pd.Timedelta(days=day_gap - 1)).dt.strftime('%Y-%m-%d')
+        return _wrap(ret, end_date)
+    return _get_date_by_gap(end_date, day_gap)
 
 
 def get_date_array(end_date: str, gap_array=None):
@@ -1,12 +1,18 @@
 import json
-from functools import reduce
+import multiprocessing as mp
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import chain, islice, repeat
 from typing import List, Dict
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
+from bds_data_science.lib.common.mapping import Encoder
 
-def column_divide(df, col_x, col_y, ret_col_name, default_nan=np.nan):
+
+def column_divide(df, col_x, col_y, ret_col_name, default_nan=np.nan, inplace=False):
     """
     Calculate the column divide result to avoid x/0 error
     :param df: data frame
@@ -14,30 +20,152 @@ def column_divide(df, col_x, col_y, ret_col_name, default_nan=np.nan):
     :param col_y: column as denominator
     :param ret: name of the result column
     :param default_nan: default value when the value of col_y is zero
+    :param inplace: add the result column to df itself, otherwise to a shallow copy sharing the other columns
     :return: col_x / col_y
     """
-    df = df.copy()
-    row_index = df[col_y] == 0
-    df.loc[row_index, ret_col_name] = default_nan
-    df.loc[-row_index, ret_col_name] = (df[col_x] / df[col_y])
+    x, y = df[col_x].to_numpy(), df[col_y].to_numpy()
+    # Integer columns like the uint8 counters give float64 ratios, as the former x / y
+    dtype = np.float32 if x.dtype == np.float32 and y.dtype == np.float32 else np.float64
+    ret = np.full(len(df), default_nan, dtype=dtype)
+    np.divide(x, y, out=ret, where=y != 0)
+    if not inplace:
+        df = df.copy(deep=False)
+    df[ret_col_name] = ret
     return df
 
 
-def merge_df(left, rights):
+class _KeyCodes:
+    """
+    Codes of the key columns of the merged frame, each column is factorized once and shared by all the right frames
+    """
+
+    def __init__(self):
+        self.uniques = {}
+        self.codes = {}
+
+    def left(self, col, values):
+        if col not in self.codes:
+            self.codes[col], self.uniques[col] = pd.factorize(values, use_na_sentinel=False)
+        return self.codes[col]
+
+    def right(self, col, values):
+        left_kind, right_kind = _key_kind(self.uniques[col]), _key_kind(values)
+        if None not in (left_kind, right_kind) and left_kind != right_kind:
+            raise ValueError('You are trying to merge on %s and %s columns for key %r, the keys must have compatible '
+                             'data types' % (left_kind, right_kind, col))
+        return pd.Index(self.uniques[col]).get_indexer(values)
+
+
+def _key_kind(values):
+    """
+    Kind of a key column compared before merging like pd.merge does, 'numeric', 'string' or 'datetime',
+    None for the other kinds which are left to the indexer
+    """
+    dtype = values.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        values = values.categories if isinstance(values, pd.Index) else pd.Series(values).cat.categories
+        dtype = values.dtype
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return 'datetime'
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_numeric_dtype(dtype):
+        return 'numeric'
+    kind = pd.api.types.infer_dtype(values, skipna=True)
+    if kind in ('string', 'bytes'):
+        return 'string'
+    if kind in ('integer', 'floating', 'mixed-integer-float', 'decimal', 'boolean'):
+        return 'numeric'
+    if kind in ('datetime64', 'datetime', 'date'):
+        return 'datetime'
+    return None
+
+
+def _combine_codes(left_codes: List[np.ndarray], right_codes: List[np.ndarray]):
+    """
+    Combine the codes of several key columns into one code shared by the left and the right frame
+    :param left_codes: codes of each key column in the left frame
+    :param right_codes: codes of each key column in the right frame, -1 for values not in the left frame
+    :return: combined left codes and right codes, right codes are -1 if any of the columns is -1
+    """
+    num_left = len(left_codes[0])
+    combined = np.concatenate([left_codes[0], right_codes[0]]).astype(np.int64)
+    missing = combined < 0
+    for left_code, right_code in zip(left_codes[1:], right_codes[1:]):
+        code = np.concatenate([left_code, right_code])
+        missing |= code < 0
+        # Re-factorize after each column so that the combined code never overflows
+        combined, uniques = pd.factorize(combined * (int(code.max()) + 1) + np.maximum(code, 0))
+    combined = np.where(missing, -1, combined)
+    return combined[:num_left], combined[num_left:]
+
+
+def merge_df(left, rights, how='left', on_duplicate='warn'):
     """
     merge one DataFrame with several DataFrames
-    merge on the intersection of left and rights columns
+    merge on the intersection of left and rights columns, like merging the rights one after another,
+    so the columns brought by a right frame can be the keys of the next ones
+
+    The key columns are factorized once and each right frame is gathered through an integer indexer, so the left frame
+    is copied only once. A right frame with duplicated keys multiplies the rows, it is merged by pd.merge after
+    reporting the expected number of rows.
     :param left: one DataFrame
-    :param rights: DataFrames
-    :return: merged DataFrame
+    :param rights: one DataFrame or list of DataFrames
+    :param how: 'left' or 'inner' use the indexers, others fall back to pd.merge
+    :param on_duplicate: action when a right frame has duplicated keys, 'warn', 'raise' or 'ignore'
+    :return: merged DataFrame, index reset
     """
-    for p_right in rights:
-        left_cols = list(left.columns)
-        right_cols = list(p_right.columns)
-        on = list(set(left_cols).intersection(set(right_cols)))
-        left = pd.merge(left, p_right, on=on, how='left')
+    if not isinstance(rights, list):
+        rights = [rights]
+    if how not in ('left', 'inner'):
+        for p_right in rights:
+            on = list(set(left.columns).intersection(set(p_right.columns)))
+            left = pd.merge(left, p_right, on=on, how=how)
+        return left
 
-    return left
+    base, rows, gathered, key_codes = left, np.arange(len(left)), {}, _KeyCodes()
+
+    def _column(col):
+        return gathered[col] if col in gathered else base[col].to_numpy()[rows]
+
+    def _materialize():
+        ret = base.iloc[rows].reset_index(drop=True)
+        for col, values in gathered.items():
+            ret[col] = values
+        return ret
+
+    for p_right in rights:
+        cols = list(base.columns) + list(gathered)
+        on = [col for col in cols if col in set(p_right.columns)]
+        if not on:
+            raise pd.errors.MergeError('No common columns to perform merge on')
+        left_codes, right_codes = _combine_codes([key_codes.left(col, _column(col)) for col in on],
+                                                 [key_codes.right(col, p_right[col]) for col in on])
+        valid = right_codes >= 0
+        num_codes = max(int(left_codes.max(initial=-1)), int(right_codes.max(initial=-1))) + 1
+        counts = np.bincount(right_codes[valid], minlength=num_codes)
+        if (counts > 1).any():
+            matches = np.where(left_codes >= 0, counts[left_codes], 0)
+            expected = int(np.maximum(matches, how == 'left').sum())
+            message = 'Duplicated keys %s in the right frame, merged rows: %d -> %d' % (on, len(rows), expected)
+            if on_duplicate == 'raise':
+                raise ValueError(message)
+            if on_duplicate == 'warn':
+                warnings.warn(message)
+            base = pd.merge(_materialize(), p_right, on=on, how=how)
+            rows, gathered, key_codes = np.arange(len(base)), {}, _KeyCodes()
+            continue
+
+        lookup = np.full(num_codes, -1, dtype=np.int64)
+        lookup[right_codes[valid]] = np.flatnonzero(valid)
+        indexer = np.where(left_codes >= 0, lookup[left_codes], -1)
+        if how == 'inner':
+            matched = indexer >= 0
+            rows, indexer = rows[matched], indexer[matched]
+            gathered = {col: values[matched] for col, values in gathered.items()}
+            key_codes = _KeyCodes()
+        for col in p_right.columns:
+            if col not in on:
+                gathered[col] = pd.api.extensions.take(p_right[col].array, indexer, allow_fill=True)
+    return _materialize()
 
 
 def df_division(df, pieces, shuffle=False):
@@ -46,16 +174,15 @@ def df_division(df, pieces, shuffle=False):
     :param df: DataFrame
     :param pieces: number of pieces
     :param shuffle: shuffle
-    :return: list of divided DataFrames
+    :return: list of divided DataFrames, positional slices of df when not shuffled
     """
-    df = df.copy()
     if shuffle:
         df = df.sample(frac=1)
     length = len(df)
     step = int(length / pieces)
     ret = []
     for i in range(0, length, step):
-        ret.append(df.loc[i:i + step - 1, :])
+        ret.append(df.iloc[i:i + step])
     return ret
 
 
@@ -71,43 +198,239 @@ def df_split_g(df: pd.DataFrame, batch_size: int):
         yield df[i: i+batch_size]
 
 
+def write_chunks(chunks, out_fn: str):
+    """
+    Write DataFrame chunks into one file, parquet if out_fn ends with .parquet (requires pyarrow), else csv
+    :param chunks: iterable of DataFrames with the same columns
+    :param out_fn: file path
+    :return: number of rows written
+    """
+    rows = 0
+    if not out_fn.endswith('.parquet'):
+        for pdf in chunks:
+            pdf.to_csv(out_fn, mode='w' if rows == 0 else 'a', header=rows == 0, index=False)
+            rows += len(pdf)
+        return rows
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writer = None
+    try:
+        for pdf in chunks:
+            table = pa.Table.from_pandas(pdf, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(out_fn, table.schema)
+            writer.write_table(table)
+            rows += len(pdf)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+def merge_chunked_g(left, right: pd.DataFrame, on=None, how='left', memory_budget=1 << 30):
+    """
+    Out-of-core merge of a left table larger than memory with a smaller right table, yield merged chunks.
+    The keys of the right table are indexed once, the left table is streamed in batches sized by the memory budget,
+    and each batch is gathered from the right table through the index.
+    :param left: DataFrame, or iterable of DataFrames like pd.read_csv(..., chunksize=...)
+    :param right: DataFrame
+    :param on: column or list of columns to merge on, the intersection of the columns if None
+    :param how: 'left' or 'inner'
+    :param memory_budget: approximate bytes of one left batch and its merged chunk,
+        the right table and its index are not counted
+    :return: generator of merged DataFrames
+    """
+    if how not in ('left', 'inner'):
+        raise ValueError('how should be left or inner, got %s' % how)
+    chunks = iter([left] if isinstance(left, pd.DataFrame) else left)
+    first = next(chunks, None)
+    if first is None:
+        return
+    if on is None:
+        on = [col for col in first.columns if col in set(right.columns)]
+    on = [on] if not isinstance(on, list) else on
+    right_cols = [col for col in right.columns if col not in on]
+
+    right_keys = pd.MultiIndex.from_frame(right[on]) if len(on) > 1 else pd.Index(right[on[0]])
+    duplicated = not right_keys.is_unique
+    right_bytes = right[right_cols].memory_usage(deep=True, index=False).sum() / max(len(right), 1)
+
+    batch_size = None
+    for chunk in chain([first], chunks):
+        if batch_size is None:
+            left_bytes = chunk.memory_usage(deep=True, index=False).sum() / max(len(chunk), 1)
+            batch_size = max(1, int(memory_budget // (2 * left_bytes + right_bytes)))
+        for batch in df_split_g(chunk, batch_size):
+            if duplicated:
+                yield pd.merge(batch, right, on=on, how=how)
+                continue
+            left_keys = pd.MultiIndex.from_frame(batch[on]) if len(on) > 1 else pd.Index(batch[on[0]])
+            indexer = right_keys.get_indexer(left_keys)
+            if how == 'inner':
+                batch, indexer = batch[indexer >= 0], indexer[indexer >= 0]
+            ret = batch.reset_index(drop=True)
+            for col in right_cols:
+                ret[col] = pd.api.extensions.take(right[col].array, indexer, allow_fill=True)
+            yield ret
+
+
+def merge_chunked(left, right: pd.DataFrame, out_fn: str, on=None, how='left', memory_budget=1 << 30):
+    """
+    Out-of-core merge written into a file chunk by chunk, see merge_chunked_g and write_chunks
+    :return: number of rows written
+    """
+    return write_chunks(tqdm(merge_chunked_g(left, right, on, how, memory_budget)), out_fn)
+
+
+# State inherited by the forked workers of parallel_map_g, so that the frame is not pickled for each batch
+_parallel_state = {}
+
+
+def _parallel_batch(start, stop):
+    return _parallel_state['func'](_parallel_state['df'][start: stop])
+
+
+def _parallel_batch_pickled(func, batch):
+    return func(batch)
+
+
+def parallel_map_g(df: pd.DataFrame, func, batch_size=100000, workers=None, backend='process'):
+    """
+    Apply func to each batch of the DataFrame on a pool of workers, yield the results in the order of the batches
+    With the process backend on platforms supporting fork, the workers inherit the frame and func read-only and only
+    receive the bounds of their batch; elsewhere the batches are pickled, and func should be picklable.
+    Only one process parallel_map_g should run at a time in a process.
+    :param df: DataFrame
+    :param func: function applied to each batch, e.g. lambda pdf: pdf.groupby('user_id').size()
+    :param batch_size: number of rows in one batch
+    :param workers: number of workers, None for the number of CPUs
+    :param backend: 'process' or 'thread', threads suit funcs releasing the GIL like numpy or IO
+    :return: generator of the results
+    """
+    spans = [(i, min(i + batch_size, len(df))) for i in range(0, len(df), batch_size)]
+    if backend == 'thread':
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            yield from tqdm(executor.map(lambda span: func(df[span[0]: span[1]]), spans), total=len(spans))
+    elif backend == 'process':
+        if 'fork' not in mp.get_all_start_methods():
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                yield from tqdm(executor.map(_parallel_batch_pickled, repeat(func), df_split_g(df, batch_size)),
+                                total=len(spans))
+            return
+        _parallel_state.update(df=df, func=func)
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('fork')) as executor:
+                yield from tqdm(executor.map(_parallel_batch, *zip(*spans)) if spans else [], total=len(spans))
+        finally:
+            _parallel_state.clear()
+    else:
+        raise ValueError('backend should be process or thread, got %s' % backend)
+
+
+def parallel_map(df: pd.DataFrame, func, batch_size=100000, workers=None, backend='process', concat=True):
+    """
+    Apply func to each batch of the DataFrame in parallel, see parallel_map_g
+    :param concat: whether to concatenate the results if they are DataFrames or Series
+    :return: concatenated result, or list of the results in the order of the batches
+    """
+    ret = list(parallel_map_g(df, func, batch_size, workers, backend))
+    if concat and ret and all(isinstance(x, (pd.DataFrame, pd.Series)) for x in ret):
+        return pd.concat(ret)
+    return ret
+
+
 def df_sample(df, frac, shuffle=False):
     """
     Extention of df.sample, can choose not to shuffle
     :param df: Input DataFrame
     :param frac: Fraction
     :param shuffle: whether to shuffle
-    :return: Part of the input DataFrame
+    :return: Part of the input DataFrame, a positional slice of it when not shuffled
     """
-    df = df.copy()
     if shuffle:
         return df.sample(frac=frac)
     else:
-        return df.loc[:len(df) * frac, :]
+        # Same rows as the former df.loc[:len(df) * frac, :] on a RangeIndex, whose end label is inclusive
+        return df.iloc[:int(len(df) * frac) + 1]
 
 
 def to_categorical(series):
     """
     transfer the series of a DataFrame into id
     :param series: pandas.Series
-    :return: a dict of value-ID mapping
+    :return: a dict of value-ID mapping, see mapping.Encoder to encode the series itself
     """
-    if isinstance(series.dtype, pd.core.dtypes.dtypes.CategoricalDtype):
-        val_set = list(series.cat.categories)
-    else:
-        val_set = series.copy().drop_duplicates().tolist()
-    val_id_map = enumerate(val_set)
-    val_id_map = {x[1]: x[0] for x in val_id_map}
-    return val_id_map
+    return Encoder().fit(series).to_dict()
+
+
+def _sort_codes(series: pd.Series, ascending=True):
+    """
+    Dense int64 codes of a column, ordered like series.sort_values(ascending=ascending, na_position='last')
+    """
+    codes, uniques = pd.factorize(series, sort=True)
+    codes = codes.astype(np.int64)
+    if not ascending:
+        codes = np.where(codes >= 0, len(uniques) - 1 - codes, codes)
+    codes[codes < 0] = len(uniques)
+    return codes
+
+
+def _group_rank(sorted_groups: np.ndarray):
+    """
+    Rank of each row in its group, starting from 1
+    :param sorted_groups: group codes, rows of the same group are contiguous
+    :return: int64 rank array
+    """
+    starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+    return np.arange(len(sorted_groups)) - np.repeat(starts, np.diff(np.r_[starts, len(sorted_groups)])) + 1
+
+
+def group_top_k(df: pd.DataFrame, groupby, by, ascending=True, top_k=10, ties='first'):
+    """
+    Vectorized top k rows of each group, with one lexsort and group offset arithmetic instead of groupby.apply
+    :param df: DataFrame
+    :param groupby: column or list of columns of the groups, rows with nan keys are dropped like groupby
+    :param by: column or list of columns to sort by
+    :param ascending: bool or list of bool, one for each column of by
+    :param top_k: number of rows kept in each group, None to keep all
+    :param ties: 'first' to keep the original order of equal rows, 'last' to reverse it
+    :return: positions of the kept rows, ordered by group keys then by the sort keys,
+             and the rank of each kept row in its group, starting from 1
+    """
+    groupby = [groupby] if not isinstance(groupby, list) else groupby
+    by = [by] if not isinstance(by, list) else by
+    ascending = [ascending] * len(by) if isinstance(ascending, bool) else list(ascending)
+    if ties not in ('first', 'last'):
+        raise ValueError('ties should be first or last, got %s' % ties)
+
+    groups = df.groupby(groupby, sort=True).ngroup().to_numpy()
+    position = np.arange(len(df))
+    keys = [position if ties == 'first' else -position]
+    keys += [_sort_codes(df[col], asc) for col, asc in reversed(list(zip(by, ascending)))]
+    keys.append(groups)
+    order = np.lexsort(keys)
+    order = order[groups[order] >= 0]
+
+    rank = _group_rank(groups[order])
+    if top_k is not None:
+        keep = rank <= top_k
+        order, rank = order[keep], rank[keep]
+    return order, rank
 
 
 def sort_ranking(df: pd.DataFrame, index_cols: list, target_col: str, top_k=10):
-    s = df.groupby(index_cols)[target_col].apply(lambda x: pd.Series(
-        [len(x) - k[0] for k in sorted(enumerate(np.argsort(x.values)), key=lambda i: i[1])])). \
-        reset_index()[[target_col]]
-    s = pd.concat([df, s.rename(columns={target_col: 'rank'})], axis=1).sort_values(by=index_cols + ['rank']). \
-        query('rank <= %d' % top_k).drop(columns=['rank'])
-    return s
+    """
+    Top k rows of each group in descending order of the target column, among equal values the later row ranks first
+    :param df: DataFrame
+    :param index_cols: columns of the groups
+    :param target_col: column to rank by
+    :param top_k: number of rows kept in each group
+    :return: kept rows, ordered by index_cols then rank, with the original index
+    """
+    order, _ = group_top_k(df, index_cols, target_col, ascending=False, top_k=top_k, ties='last')
+    return df.iloc[order]
 
 
 def dict2df(dic: dict, key_col_name='key', val_col_name='val', flatten=False):
@@ -134,14 +457,10 @@ def dict2df(dic: dict, key_col_name='key', val_col_name='val', flatten=False):
     if not flatten:
         return pd.DataFrame({key_col_name: list(dic.keys()), val_col_name: list(dic.values())})
     else:
-        ret = []
-        for k, v in dic.items():
-            if len(v) == 0:
-                continue
-            pdf = pd.DataFrame({val_col_name: v})
-            pdf[key_col_name] = k
-            ret.append(pdf)
-        return pd.concat(ret)
+        values = list(dic.values())
+        offsets = np.r_[0, np.cumsum([len(v) for v in values])].astype(np.int64)
+        ret = ragged2df(list(dic.keys()), offsets, list(chain.from_iterable(values)), key_col_name, val_col_name)
+        return ret[[val_col_name, key_col_name]]
 
 
 def sort_ranking_test():
@@ -154,34 +473,221 @@ def sort_ranking_test():
     print(r)
 
 
+def group_ragged(df: pd.DataFrame, by, target: str):
+    """
+    Gather the target column of each group into a ragged array, with one stable sort
+    :param df: DataFrame
+    :param by: column or list of columns of the groups, rows with nan keys are dropped like groupby
+    :param target: column to gather
+    :return: group keys (Index or MultiIndex, sorted), offsets with shape (num_group + 1,) and values,
+             values[offsets[i]: offsets[i + 1]] are the target values of group i in their original order
+    """
+    grouped = df.groupby(by, sort=True)
+    # ngroup is nan for the rows with nan keys
+    codes = grouped.ngroup().fillna(-1).to_numpy().astype(np.int64)
+    order = np.argsort(codes, kind='stable')
+    order = order[codes[order] >= 0]
+    offsets = np.r_[0, np.cumsum(np.bincount(codes[order], minlength=grouped.ngroups))].astype(np.int64)
+    return grouped.size().index, offsets, df[target].to_numpy()[order]
+
+
+def _list_str(values: np.ndarray):
+    """
+    String of each element like in str(list), spaces and double quotes removed
+    """
+    series = pd.Series(values)
+    kind = pd.api.types.infer_dtype(series, skipna=False)
+    if kind == 'string':
+        series = "'" + series.astype(str) + "'"
+    elif kind in ('integer', 'floating', 'boolean', 'mixed-integer-float'):
+        # astype(str) keeps nan as missing, which str.cat would drop
+        series = series.astype(str).fillna('nan')
+    else:
+        series = series.map(repr)
+    return series.str.replace(' ', '').str.replace('"', '')
+
+
+def ragged_join(offsets: np.ndarray, values: np.ndarray, sep=',', chunk_size=10000000, to_str=_list_str):
+    """
+    Join the values of each group of a ragged array into one string, chunk by chunk.
+    Instead of one str() per group, the element strings are suffixed with sep, or with a group separator for the
+    last element of a group, concatenated once and split at the group separators.
+    :param offsets: offsets with shape (num_group + 1,), see group_ragged
+    :param values: values
+    :param sep: separator of the values
+    :param chunk_size: approximate number of values joined at once, bounds the memory of the joined string
+    :param to_str: function converting an array of values into a Series of strings
+    :return: list of strings, '' for empty groups
+    """
+    group_sep = '\x00'
+    ret = [''] * (len(offsets) - 1)
+    group = 0
+    while group < len(offsets) - 1:
+        end = max(group + 1, int(np.searchsorted(offsets, offsets[group] + chunk_size, side='right')) - 1)
+        lo, hi = offsets[group], offsets[end]
+        if hi > lo:
+            ends = offsets[group + 1: end + 1]
+            non_empty = np.flatnonzero(np.diff(offsets[group: end + 1]) > 0)
+            strings = to_str(values[lo: hi]).fillna('nan')
+            if strings.str.contains(group_sep, regex=False).any():
+                # The group separator can not be used, join the groups one by one
+                strings = strings.tolist()
+                bounds = offsets[group: end + 1] - lo
+                joined = [sep.join(strings[bounds[i]: bounds[i + 1]]) for i in non_empty]
+            else:
+                delims = np.full(hi - lo, sep, dtype=object)
+                delims[ends[non_empty] - 1 - lo] = group_sep
+                joined = (strings + delims).str.cat(na_rep='nan').split(group_sep)[:-1]
+            for i, string in zip(non_empty, joined):
+                ret[group + i] = string
+        group = end
+    return ret
+
+
+def ragged2df(keys, offsets: np.ndarray, values, key_col_name='key', val_col_name='val'):
+    """
+    Explode a ragged array into a long format DataFrame with np.repeat
+    :param keys: key of each group, list-like with shape (num_group,)
+    :param offsets: offsets with shape (num_group + 1,), see group_ragged
+    :param values: values, list-like with shape (offsets[-1],)
+    :param key_col_name: key column name
+    :param val_col_name: value column name
+    :return: DataFrame of (key_col_name, val_col_name), the index is the position of the value in its group
+    """
+    lengths = np.diff(offsets)
+    index = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+    return pd.DataFrame({key_col_name: pd.Series(keys).to_numpy().repeat(lengths), val_col_name: values},
+                        index=index)
+
+
 def df_flatten(df: pd.DataFrame, by: str, target: str, to_str=True):
-    ret = df.groupby(by)[target].apply(lambda x: x.to_list()).reset_index()
+    """
+    Gather the target values of each group
+    :param df: DataFrame
+    :param by: column of the groups
+    :param target: column to gather
+    :param to_str: whether to join the values into a string like '1,2,3', else a list of values
+    :return: DataFrame of (by, target), one row for each group
+    """
+    keys, offsets, values = group_ragged(df, by, target)
     if to_str:
-        ret[target] = ret[target].apply(lambda x: str(x)[1:-1].replace(' ', '').replace('\"', ''))
+        flattened = ragged_join(offsets, values)
+    else:
+        flattened = [values[lo: hi].tolist() for lo, hi in zip(offsets[:-1], offsets[1:])]
+    ret = keys.to_frame(index=False)
+    ret[target] = flattened
     return ret
 
 
 def group_sort_select(df: pd.DataFrame, groupby, target_cols, ascending=True, top_k=10, remove_traget=False):
+    """
+    Top k rows of each group sorted by the target columns
+    :param df: DataFrame
+    :param groupby: column or list of columns of the groups
+    :param target_cols: column or list of columns to sort by
+    :param ascending: bool or list of bool
+    :param top_k: number of rows kept in each group
+    :param remove_traget: whether to drop the target columns
+    :return: kept rows with the target columns first, ordered by groupby then target_cols, index reset
+    """
+    target_cols = [target_cols] if not isinstance(target_cols, list) else target_cols
+    order, _ = group_top_k(df, groupby, target_cols, ascending=ascending, top_k=top_k)
+    rest_cols = [col for col in df.columns if col not in target_cols]
+    cols = rest_cols if remove_traget else target_cols + rest_cols
+    return df.iloc[order][cols].reset_index(drop=True)
+
+
+def group_select(df: pd.DataFrame, groupby, nums=10, frac=None, weights=None, seed=None):
+    """
+    Stratified sampling, randomly select rows of each group without replacement.
+    Each row gets a random key, rows are sorted by group and key once, and the rows ranked within the quota of their
+    group are kept. With weights, the key is -log(u) / weight so that heavier rows are more likely to be selected.
+    :param df: DataFrame
+    :param groupby: column or list of columns of the groups
+    :param nums: number of rows selected in each group, or a Series of quota indexed by the group keys,
+                 groups missing from the Series select nothing. Groups smaller than the quota are kept entirely.
+    :param frac: fraction of rows selected in each group, rounded like DataFrame.sample, has priority over nums
+    :param weights: column name or array of non-negative sampling weights, rows of zero weight are never selected
+    :param seed: random seed
+    :return: selected rows, groupby columns first, ordered by group keys, index reset
+    """
+    groupby = [groupby] if not isinstance(groupby, list) else groupby
+    rest_columns = [col for col in df.columns if col not in groupby]
+    grouped = df.groupby(groupby, sort=True)
+    # Rows with nan keys get -1 and are dropped like groupby
+    groups = grouped.ngroup().fillna(-1).to_numpy().astype(np.int64)
+
+    if frac is not None:
+        quota = np.round(grouped.size().to_numpy() * frac)
+    elif isinstance(nums, pd.Series):
+        quota = nums.reindex(grouped.size().index).fillna(0).to_numpy()
+    else:
+        quota = np.full(grouped.ngroups, nums)
+
+    rng = np.random.default_rng(seed)
+    keys = rng.random(len(df))
+    if weights is not None:
+        weights = df[weights].to_numpy() if isinstance(weights, str) else np.asarray(weights)
+        if (weights < 0).any():
+            raise ValueError('weight vector may not include negative values')
+        with np.errstate(divide='ignore'):
+            keys = -np.log(keys) / weights
+    order = np.lexsort((keys, groups))
+    order = order[groups[order] >= 0]
+    if weights is not None:
+        order = order[np.isfinite(keys[order])]
+    order = order[_group_rank(groups[order]) <= quota[groups[order]]]
+    return df.iloc[order][groupby + rest_columns].reset_index(drop=True)
+
+
+def _sort_ranking_apply(df: pd.DataFrame, index_cols: list, target_col: str, top_k=10):
+    """
+    Previous groupby.apply implementation of sort_ranking, kept for group_top_k_benchmark
+    """
+    s = df.groupby(index_cols)[target_col].apply(lambda x: pd.Series(
+        [len(x) - k[0] for k in sorted(enumerate(np.argsort(x.values)), key=lambda i: i[1])])). \
+        reset_index()[[target_col]]
+    s = pd.concat([df, s.rename(columns={target_col: 'rank'})], axis=1).sort_values(by=index_cols + ['rank']). \
+        query('rank <= %d' % top_k).drop(columns=['rank'])
+    return s
+
+
+def _group_sort_select_apply(df: pd.DataFrame, groupby, target_cols, ascending=True, top_k=10):
+    """
+    Previous groupby.apply implementation of group_sort_select, kept for group_top_k_benchmark
+    """
     groupby = [groupby] if not isinstance(groupby, list) else groupby
     target_cols = [target_cols] if not isinstance(target_cols, list) else target_cols
-    index_level = len(groupby)
-    index_level = 'level_%d' % index_level
+    index_level = 'level_%d' % len(groupby)
 
     df = df.reset_index()
     ret = df.groupby(groupby)[target_cols + ['index']]. \
         apply(lambda x: x.sort_values(by=target_cols, ascending=ascending).head(top_k))
     ret = ret.reset_index().drop(columns=[index_level] + list(groupby))
-    if remove_traget:
-        ret=ret.drop(columns=target_cols)
     ret = pd.merge(ret, df.drop(columns=target_cols), on='index', how='left').drop(columns='index')
     return ret
 
 
-def group_select(df: pd.DataFrame, groupby, nums=10):
-    groupby = [groupby] if not isinstance(groupby, list) else groupby
-    rest_columns = list(set(df.columns) - set(groupby))
-    return df.groupby(groupby)[rest_columns].apply(
-        lambda x: x.sample(n=nums) if len(x) > nums else x).reset_index().drop(columns='level_1')
+def group_top_k_benchmark(num_rows=1000000, num_groups=100000, top_k=10):
+    """
+    Time cost in seconds of sort_ranking and group_sort_select against their previous implementations
+    """
+    sp_df = pd.DataFrame({
+        'user_id': np.sort(np.random.randint(0, num_groups, num_rows)),
+        'score': np.random.randint(0, 40, num_rows),
+        'count': np.random.randint(1, 20, num_rows),
+    })
+    ret = {}
+    for name, func, args in [
+        ('sort_ranking', sort_ranking, (['user_id'], 'score', top_k)),
+        ('sort_ranking_apply', _sort_ranking_apply, (['user_id'], 'score', top_k)),
+        ('group_sort_select', group_sort_select, ('user_id', ['count', 'score'], False, top_k)),
+        ('group_sort_select_apply', _group_sort_select_apply, ('user_id', ['count', 'score'], False, top_k)),
+    ]:
+        start = time.time()
+        func(sp_df, *args)
+        ret[name] = time.time() - start
+    return ret
 
 
 def dtype_cast(df: pd.DataFrame, dtypes: Dict[str, str]):
@@ -228,6 +734,21 @@ def df_division_test():
         print(len(x))
 
 
+def copy_free_test():
+    import tracemalloc
+    df = pd.DataFrame(np.random.rand(1000000, 8), columns=['col{}'.format(i) for i in range(8)])
+    frame_size = df.memory_usage(index=False).sum()
+    tracemalloc.start()
+    column_divide(df, 'col0', 'col1', 'ratio', inplace=True)
+    column_divide(df, 'col2', 'col3', 'ratio2')
+    df_division(df, 4)
+    df_sample(df, 0.5)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(peak / frame_size)
+    assert peak < frame_size / 2
+
+
 def df_split_test():
     df = pd.DataFrame({'col1': list(range(100000))})
     split = df_split(df, batch_size=50000)
@@ -257,25 +778,91 @@ def df_flatten_test():
     print(ret)
 
 
-def json_de_flatten(fn, flatten_cols):
-    with open(fn, 'r', encoding='utf-8') as fin:
-        lst = json.load(fin)
-        ret = []
-        index_cols = [x for x in lst[0].keys() if x not in flatten_cols]
-        flatten_size = {x: len(lst[0][x].split(',')) for x in flatten_cols}
-        for dic in tqdm(lst):
-            flattened = reduce(lambda x, y: {**x, **y},
-                               [{"{col}_{cnt}".format(col=col, cnt=cnt): dic[col].split(',')[cnt]
-                                 for col, cnt in zip(
-                                       [c for _ in range(flatten_size[c])],
-                                       [i for i in range(flatten_size[c])])} for c in flatten_cols])
-
-            ret.append({
-                **flattened,
-                **{col: dic[col] for col in index_cols}
-            })
-        df = pd.DataFrame(data=ret)
-        return df
+def _iter_json_records(fin, buffer_size=1 << 20):
+    """
+    Iterate over the records of a JSON array or of JSON lines without loading the whole file
+    :param fin: text file object
+    :param buffer_size: number of characters read at once
+    :return: generator of records
+    """
+    decoder = json.JSONDecoder()
+    buffer, pos, eof = '', 0, False
+    while True:
+        # Skip the whitespaces, the brackets and the commas between records
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n[],':
+            pos += 1
+        if pos == len(buffer):
+            if eof:
+                return
+            buffer, pos = fin.read(buffer_size), 0
+            eof = len(buffer) == 0
+            continue
+        try:
+            record, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            more = fin.read(buffer_size)
+            if not more:
+                raise
+            buffer, pos = buffer[pos:] + more, 0
+            continue
+        if end == len(buffer) and not eof:
+            # A number at the end of the buffer may be truncated, decode it again with more data
+            more = fin.read(buffer_size)
+            if more:
+                buffer, pos = buffer[pos:] + more, 0
+                continue
+            eof = True
+        yield record
+        pos = end
+
+
+def json_de_flatten_g(fn, flatten_cols, chunk_size=100000, dtypes: Dict[str, str] = None, encoding='utf-8'):
+    """
+    Streaming version of json_de_flatten, yield DataFrame chunks
+    :param fn: JSON file, a JSON array or JSON lines of records
+    :param flatten_cols: columns packed as comma separated strings,
+        column col is split into col_0, col_1, ..., the number of elements is given by the first record
+    :param chunk_size: number of records in one chunk
+    :param dtypes: {column: data type} applied to each chunk, see dtype_cast
+    :param encoding: encoding of the file
+    :return: generator of DataFrames
+    """
+    with open(fn, 'r', encoding=encoding) as fin:
+        records = _iter_json_records(fin)
+        flatten_size, index_cols = None, None
+        while True:
+            chunk = list(islice(records, chunk_size))
+            if not chunk:
+                return
+            if flatten_size is None:
+                index_cols = [x for x in chunk[0].keys() if x not in flatten_cols]
+                flatten_size = {x: len(chunk[0][x].split(',')) for x in flatten_cols}
+            pdf = pd.DataFrame(chunk)
+            parts = []
+            for col in flatten_cols:
+                split = pdf[col].str.split(',', expand=True).reindex(columns=range(flatten_size[col]))
+                split.columns = ['{col}_{cnt}'.format(col=col, cnt=cnt) for cnt in range(flatten_size[col])]
+                parts.append(split)
+            pdf = pd.concat(parts + [pdf[index_cols]], axis=1)
+            yield pdf if dtypes is None else dtype_cast(pdf, dtypes)
+
+
+def json_de_flatten(fn, flatten_cols, chunk_size=100000, dtypes: Dict[str, str] = None):
+    """
+    Load a JSON file whose flatten_cols are packed as comma separated strings, see json_de_flatten_g
+    :return: DataFrame
+    """
+    return pd.concat(list(tqdm(json_de_flatten_g(fn, flatten_cols, chunk_size, dtypes))), ignore_index=True)
+
+
+def json_de_flatten_to_parquet(fn, out_fn, flatten_cols, chunk_size=100000, dtypes: Dict[str, str] = None):
+    """
+    Convert a JSON file whose flatten_cols are packed as comma separated strings into a parquet file chunk by chunk,
+    see json_de_flatten_g. Requires pyarrow.
+    :param out_fn: parquet file path
+    :return: number of rows written
+    """
+    return write_chunks(tqdm(json_de_flatten_g(fn, flatten_cols, chunk_size, dtypes)), out_fn)
 
 
 def json_de_flatten_test():
@@ -2,25 +2,20 @@ import numpy as np
 import pandas as pd
 import copy
 
+from bds_data_science.lib.common import df_ops
+
 
 def merge_df(left, rights, how='left') -> pd.DataFrame:
     """
     merge one DataFrame with several DataFrames
-    merge on the intersection of left and rights columns
+    merge on the intersection of left and rights columns, see df_ops.merge_df
     :rtype: object
     :param how: string
     :param left: one DataFrame
     :param rights: one DataFrame or list of DataFrames
     :return: merged DataFrame
     """
-    if not isinstance(rights, list):
-        rights = [rights]
-    for p_right in rights:
-        left_cols = list(left.columns)
-        right_cols = list(p_right.columns)
-        on = list(set(left_cols).intersection(set(right_cols)))
-        left = pd.merge(left, p_right, on=on, how=how)
-    return left
+    return df_ops.merge_df(left, rights, how=how)
 
 
 def tpfn(y_true, y_pred):
@@ -0,0 +1,203 @@
+"""
+Columnar store for the feature tables whose schemas are defined in common.py, e.g. ctr_feature_dtype.
+
+Each daily partition is written as typed column files, .npy by default or one uncompressed Feather file with pyarrow,
+so that training jobs memory-map only the columns and the rows they need instead of parsing csv files.
+The string columns like user_id are dictionary encoded with a mapping.Encoder shared by all the partitions.
+
+root/
+    meta.json               schema, format, dictionary encoded columns and partitions with their number of rows
+    vocab/user_id.npz       vocabulary of user_id, see mapping.Encoder
+    20201017/op_code.npy    one file per column with the npy format
+    20201017.feather        one file per partition with the feather format
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from bds_data_science.lib.common.mapping import Encoder
+from bds_data_science.lib.common.pandas_utils import get_schema, optimize_memory
+
+FORMATS = ('npy', 'feather')
+
+
+class FeatureStore:
+    """
+    >>> store = FeatureStore('./ctr_store', schema='ctr_feature')
+    >>> store.append(df, '20201017')
+    >>> store = FeatureStore('./ctr_store')
+    >>> store.read(['user_id', 'op_code', 'click_cnt'], partitions=['20201016', '20201017'], start=0, stop=1000000)
+    """
+
+    def __init__(self, root: str, schema: dict or str = None, fmt='npy', dict_columns=None):
+        """
+        Open the store at root, or create it if it does not exist yet
+        :param root: directory of the store
+        :param schema: {column: data type} or name of a schema in common.py, required to create the store
+        :param fmt: 'npy' or 'feather', the feather format requires pyarrow
+        :param dict_columns: dictionary encoded columns, all the 'str' columns of the schema by default
+        """
+        self.root = root
+        meta_fn = os.path.join(root, 'meta.json')
+        if os.path.exists(meta_fn):
+            with open(meta_fn, 'r', encoding='utf-8') as fin:
+                meta = json.load(fin)
+        else:
+            if schema is None:
+                raise ValueError('No store at {}, a schema is required to create it'.format(root))
+            if fmt not in FORMATS:
+                raise ValueError('fmt must be one of {}, got {}'.format(FORMATS, fmt))
+            if isinstance(schema, str):
+                schema = get_schema(schema)
+            if dict_columns is None:
+                dict_columns = [col for col, dtype in schema.items() if dtype == 'str']
+            meta = {'schema': dict(schema), 'format': fmt, 'dict_columns': list(dict_columns), 'partitions': []}
+        self.schema = meta['schema']
+        self.fmt = meta['format']
+        self.dict_columns = meta['dict_columns']
+        self.partitions = meta['partitions']
+        self.encoders = {}
+        for col in self.dict_columns:
+            vocab_fn = self._vocab_fn(col)
+            self.encoders[col] = Encoder.load(vocab_fn) if os.path.exists(vocab_fn) else Encoder()
+
+    @property
+    def columns(self):
+        return list(self.schema.keys())
+
+    @property
+    def partition_names(self):
+        return [x['name'] for x in self.partitions]
+
+    def __len__(self):
+        return sum(x['rows'] for x in self.partitions)
+
+    def _vocab_fn(self, col):
+        return os.path.join(self.root, 'vocab', col + '.npz')
+
+    def _save_meta(self):
+        meta = {'schema': self.schema, 'format': self.fmt, 'dict_columns': self.dict_columns,
+                'partitions': self.partitions}
+        meta_fn = os.path.join(self.root, 'meta.json')
+        with open(meta_fn + '.tmp', 'w', encoding='utf-8') as fout:
+            json.dump(meta, fout, indent=2)
+        os.replace(meta_fn + '.tmp', meta_fn)
+
+    def append(self, df: pd.DataFrame, partition: str):
+        """
+        Write a DataFrame as a new partition, its columns are cast to the schema and the dictionary encoded columns
+        are encoded, the new values being appended to their vocabularies
+        :param df: DataFrame with all the columns of the schema
+        :param partition: name of the partition, e.g. the date '20201017'
+        :return: number of rows written
+        """
+        partition = str(partition)
+        if partition in self.partition_names:
+            raise ValueError('Partition {} already exists'.format(partition))
+        missing = [col for col in self.columns if col not in df.columns]
+        if missing:
+            raise KeyError('Columns {} of the schema not in the DataFrame'.format(missing))
+        df, _ = optimize_memory(df[self.columns], self.schema)
+        arrays = {}
+        for col in self.columns:
+            if col in self.encoders:
+                # Missing values are not in the vocabulary and are coded as -1, i.e. NaN in the categoricals
+                values = df[col].to_numpy()
+                na = pd.isna(values)
+                codes = np.full(len(values), -1, dtype=np.int32)
+                codes[~na] = self.encoders[col].transform(values[~na], unseen='extend')
+                arrays[col] = codes
+            else:
+                arrays[col] = df[col].to_numpy()
+
+        os.makedirs(os.path.join(self.root, 'vocab'), exist_ok=True)
+        if self.fmt == 'npy':
+            os.makedirs(os.path.join(self.root, partition))
+            for col, arr in arrays.items():
+                np.save(os.path.join(self.root, partition, col + '.npy'), arr)
+        else:
+            from pyarrow import feather
+
+            feather.write_feather(pd.DataFrame(arrays), os.path.join(self.root, partition + '.feather'),
+                                  compression='uncompressed')
+        # The vocabularies are saved before the meta, a partition is only visible once all its codes are known
+        for col, encoder in self.encoders.items():
+            encoder.save(self._vocab_fn(col))
+        self.partitions.append({'name': partition, 'rows': len(df)})
+        self._save_meta()
+        return len(df)
+
+    def _read_partition(self, partition: str, columns: list, start: int, stop: int):
+        """
+        Read the rows [start, stop) of some columns of a partition through memory maps
+        :return: {column: array}
+        """
+        if self.fmt == 'npy':
+            return {col: np.load(os.path.join(self.root, partition, col + '.npy'), mmap_mode='r')[start:stop]
+                    for col in columns}
+        from pyarrow import feather
+
+        table = feather.read_table(os.path.join(self.root, partition + '.feather'), columns=columns,
+                                   memory_map=True)
+        table = table.slice(start, stop - start)
+        return {col: table.column(col).to_numpy() for col in columns}
+
+    def read(self, columns: list = None, partitions: list = None, start: int = None, stop: int = None,
+             decode=True):
+        """
+        Load some columns of some partitions, only the requested column files and rows are read
+        :param columns: columns to load, all by default
+        :param partitions: names of the partitions, in the order of the result, all by default
+        :param start: first row of the concatenated partitions
+        :param stop: row after the last row of the concatenated partitions
+        :param decode: return the dictionary encoded columns as categoricals of their values, else as int32 codes
+        :return: DataFrame
+        """
+        columns = self.columns if columns is None else list(columns)
+        unknown = [col for col in columns if col not in self.schema]
+        if unknown:
+            raise KeyError('Columns {} not in the schema'.format(unknown))
+        rows = {x['name']: x['rows'] for x in self.partitions}
+        partitions = self.partition_names if partitions is None else [str(x) for x in partitions]
+        unknown = [x for x in partitions if x not in rows]
+        if unknown:
+            raise KeyError('Partitions {} not in the store'.format(unknown))
+
+        total = sum(rows[x] for x in partitions)
+        start, stop, _ = slice(start, stop).indices(total)
+        parts, offset = [], 0
+        for partition in partitions:
+            lo, hi = max(start - offset, 0), min(stop - offset, rows[partition])
+            offset += rows[partition]
+            if lo < hi:
+                parts.append(self._read_partition(partition, columns, lo, hi))
+
+        ret = {}
+        for col in columns:
+            if parts:
+                arr = np.concatenate([part[col] for part in parts])
+            else:
+                arr = np.empty(0, dtype=np.int32 if col in self.encoders else self.schema[col])
+            if col in self.encoders and decode:
+                arr = pd.Categorical.from_codes(arr, categories=self.encoders[col].vocab)
+            ret[col] = arr
+        return pd.DataFrame(ret, columns=columns)
+
+
+def feature_store_test():
+    from bds_data_science.lib.common.common import ctr_feature_dtype
+
+    store = FeatureStore('./ctr_store', schema=ctr_feature_dtype)
+    for day in ['20201016', '20201017']:
+        df = pd.DataFrame({col: np.random.randint(0, 100, 1000) for col in ctr_feature_dtype})
+        df['user_id'] = ['u{}'.format(x) for x in np.random.randint(0, 300, 1000)]
+        store.append(df, day)
+    print(len(store), store.partition_names)
+    print(FeatureStore('./ctr_store').read(['user_id', 'op_code', 'click_cnt'], start=900, stop=1100))
+
+
+if __name__ == '__main__':
+    feature_store_test()
@@ -6,6 +6,8 @@ import requests
 
 from io import BytesIO, StringIO
 
+from bds_data_science.lib.common.pandas_utils import get_schema, optimize_memory
+
 
 def current_module(path):
     return os.path.split(path)[-1].split('.')[0]
@@ -141,6 +143,33 @@ def success_request(
     requests.get(request_url)
 
 
+def load_df(fn, schema: dict or str = None, optimize=False, chunksize=1000000, **kwargs):
+    """
+    Load a csv file into a DataFrame chunk by chunk, applying a dtype schema or the memory optimizer to each chunk
+    :param fn: file path
+    :param schema: {column: data type} or name of a schema in common.py, see pandas_utils.optimize_memory
+    :param optimize: whether to infer the smallest data types when no schema is given
+    :param chunksize: number of rows parsed at once
+    :param kwargs: other arguments of pd.read_csv
+    :return: DataFrame
+    """
+    if isinstance(schema, str):
+        schema = get_schema(schema)
+    if schema is not None:
+        # Keep the string columns like user_id from being parsed as numbers
+        kwargs.setdefault('dtype', {col: dtype for col, dtype in schema.items() if dtype == 'str'})
+    chunks = []
+    for chunk in pd.read_csv(fn, chunksize=chunksize, **kwargs):
+        if schema is not None or optimize:
+            chunk, _ = optimize_memory(chunk, schema)
+        chunks.append(chunk)
+    df = pd.concat(chunks, ignore_index=True)
+    if schema is None and optimize and len(chunks) > 1:
+        # Categoricals of different chunks are concatenated as strings, optimize them again
+        df, _ = optimize_memory(df)
+    return df
+
+
 def load_json(fn, encoding='utf-8', lines=None):
     if lines is None:
         with open(fn, 'r', encoding=encoding) as fin:
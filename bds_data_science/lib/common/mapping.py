@@ -1,6 +1,9 @@
 from typing import List
 import math
 
+import numpy as np
+import pandas as pd
+
 
 def hash_mapping(seq: List[str]):
     """
@@ -18,9 +21,155 @@ def index_mapping(seq: List[str]):
     :return:
     """
     size = 10 ** len(str(int(len(seq))))
+    encoder = Encoder(seq, offset=size)
+    if encoder.vocab.is_unique:
+        return encoder.to_dict()
+    # Codes are positions in seq, the last occurrence of a duplicated string wins
     return {x[1]: x[0]+size for x in enumerate(seq)}
 
 
+class Encoder:
+    """
+    Encode values as consecutive integer codes. Fitted with pd.factorize, values are coded in order of appearance,
+    new data is encoded through the hash table of a pd.Index and the vocabulary can be extended incrementally.
+
+    >>> encoder = Encoder().fit(df['user_id'])
+    >>> codes = encoder.transform(new_df['user_id'], unseen='extend')
+    >>> encoder.save('user_id.npz')
+    >>> encoder = Encoder.load('user_id.npz')
+    """
+
+    def __init__(self, vocab=None, offset=0, unseen_code=-1):
+        """
+        :param vocab: existing vocabulary, value vocab[i] is encoded as offset + i
+        :param offset: code of the first value
+        :param unseen_code: code of the values not in the vocabulary when they are ignored
+        """
+        self.vocab = pd.Index([] if vocab is None else vocab)
+        self.offset = offset
+        self.unseen_code = unseen_code
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def fit(self, values):
+        """
+        Build the vocabulary, the categories are taken as they are for a categorical Series
+        :param values: array-like of values
+        :return: self
+        """
+        if isinstance(getattr(values, 'dtype', None), pd.CategoricalDtype):
+            self.vocab = pd.Index(values.cat.categories)
+        else:
+            _, uniques = pd.factorize(np.asarray(values), use_na_sentinel=False)
+            self.vocab = pd.Index(uniques)
+        return self
+
+    def partial_fit(self, values):
+        """
+        Append the values not in the vocabulary to it, the codes of the known values are kept
+        :param values: array-like of values
+        :return: self
+        """
+        self._extend(np.asarray(values), self.get_indexer(values))
+        return self
+
+    def _extend(self, values: np.ndarray, positions: np.ndarray):
+        unseen = positions < 0
+        if unseen.any():
+            new_positions, new_values = pd.factorize(values[unseen], use_na_sentinel=False)
+            positions[unseen] = new_positions + len(self.vocab)
+            self.vocab = self.vocab.append(pd.Index(new_values))
+        return positions
+
+    def get_indexer(self, values):
+        """
+        Positions of the values in the vocabulary, -1 for unseen values
+        :param values: array-like of values
+        :return: int64 array
+        """
+        return self.vocab.get_indexer(np.asarray(values)).astype(np.int64)
+
+    def transform(self, values, unseen='ignore'):
+        """
+        Encode the values
+        :param values: array-like or Series of values
+        :param unseen: 'ignore' to encode unseen values as unseen_code, 'extend' to append them to the vocabulary
+            or 'error' to raise a KeyError
+        :return: int64 codes, a Series with the same index if values is a Series
+        """
+        if unseen not in ('ignore', 'extend', 'error'):
+            raise ValueError('unseen must be ignore, extend or error, got {}'.format(unseen))
+        positions = self.get_indexer(values)
+        if unseen == 'extend':
+            positions = self._extend(np.asarray(values), positions)
+        missing = positions < 0
+        if unseen == 'error' and missing.any():
+            raise KeyError('{} values not in the vocabulary, e.g. {}'.format(
+                missing.sum(), np.asarray(values)[missing][:5].tolist()))
+        codes = np.where(missing, self.unseen_code, positions + self.offset)
+        if isinstance(values, pd.Series):
+            return pd.Series(codes, index=values.index, name=values.name)
+        return codes
+
+    def fit_transform(self, values):
+        return self.fit(values).transform(values)
+
+    def inverse_transform(self, codes):
+        """
+        Decode the codes, unseen_code is decoded as None
+        :param codes: array-like of codes
+        :return: object array of values
+        """
+        positions = np.asarray(codes, dtype=np.int64) - self.offset
+        valid = (positions >= 0) & (positions < len(self.vocab))
+        ret = np.full(len(positions), None, dtype=object)
+        ret[valid] = self.vocab.to_numpy()[positions[valid]]
+        return ret
+
+    def to_dict(self):
+        """
+        :return: {value: code}
+        """
+        return dict(zip(self.vocab.tolist(), range(self.offset, self.offset + len(self.vocab))))
+
+    def save(self, fp: str):
+        """
+        Save the vocabulary into a .npz file, strings are stored as utf-8 bytes, their end offsets and the positions
+        of the missing values
+        :param fp: file path
+        :return: None
+        """
+        vocab = self.vocab.to_numpy()
+        meta = np.array([self.offset, self.unseen_code], dtype=np.int64)
+        if vocab.dtype == object:
+            na = pd.isna(vocab)
+            encoded = [b'' if is_na else str(x).encode('utf-8') for x, is_na in zip(vocab, na)]
+            ends = np.cumsum([len(x) for x in encoded], dtype=np.int64)
+            np.savez(fp, meta=meta, data=np.frombuffer(b''.join(encoded), dtype=np.uint8), ends=ends,
+                     na=np.flatnonzero(na))
+        else:
+            np.savez(fp, meta=meta, vocab=vocab)
+
+    @classmethod
+    def load(cls, fp: str):
+        """
+        Load the vocabulary from a .npz file
+        :param fp: file path
+        :return: Encoder
+        """
+        with np.load(fp) as npz:
+            offset, unseen_code = npz['meta'].tolist()
+            if 'vocab' in npz.files:
+                vocab = npz['vocab']
+            else:
+                data, ends = npz['data'].tobytes(), npz['ends']
+                starts = np.concatenate([[0], ends[:-1]])
+                vocab = np.array([data[s:e].decode('utf-8') for s, e in zip(starts, ends)], dtype=object)
+                vocab[npz['na']] = np.nan
+        return cls(vocab, offset=offset, unseen_code=unseen_code)
+
+
 if __name__ == '__main__':
     sp_seq = ['a123', 'b234', 'c145']
     # sp_map = hash_mapping(sp_seq)
@@ -2,14 +2,27 @@
 In this collaborative filtering model, the matrix with shape (m, n) will be regarded as a list of m vectors with size n.
 The vector is the representation of a user or item, and the matrix is the set of the users or items.
 
-To save memory, we use np.int16 and np.float16 as data type of arrays.
+To save memory, arrays are stored as np.int16 and np.float16 by default, see PrecisionPolicy.
+The productions are computed in np.float32 blocks, since float16 arithmetic is emulated and slow on CPUs.
 """
 
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
 import numpy as np
+import pandas as pd
 from scipy.sparse import csr_matrix
 from scipy.sparse import csr
+from scipy.sparse import diags
+from scipy.sparse import issparse
+from scipy.sparse import vstack as sparse_vstack
 from tqdm import tqdm
 
+from bds_data_science.lib.common.mapping import Encoder
+
 
 def dtype_cast(arr: np.ndarray or csr.csr_matrix):
     dtype = str(np.dtype(arr.dtype))
@@ -24,6 +37,99 @@ def dtype_cast(arr: np.ndarray or csr.csr_matrix):
     return arr
 
 
+class PrecisionPolicy:
+    """
+    Data types used by the cosine functions
+
+    storage_dtype: data type float arrays are kept in, scipy.sparse has no float16 so sparse arrays use float32
+    storage_int_dtype: data type int arrays are kept in, promoted to a wider int type if the values overflow it
+    compute_dtype: data type of the blocks fed to the matrix production
+    accumulate_dtype: data type of the sums of squares of the l2 norm
+
+    None for a storage data type means the array is kept as it is.
+    """
+
+    def __init__(self, storage_dtype=np.float16, compute_dtype=np.float32, accumulate_dtype=np.float32,
+                 storage_int_dtype=np.int16):
+        self.storage_dtype = storage_dtype
+        self.storage_int_dtype = storage_int_dtype
+        self.compute_dtype = compute_dtype
+        self.accumulate_dtype = accumulate_dtype
+
+    def _int_dtype(self, arr: np.ndarray or csr.csr_matrix):
+        values = arr.data if isinstance(arr, csr.csr_matrix) else arr
+        if values.size == 0:
+            return self.storage_int_dtype
+        low, high = values.min(), values.max()
+        for dtype in (self.storage_int_dtype, np.int32, np.int64):
+            if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+                return dtype
+        return arr.dtype
+
+    def store(self, arr: np.ndarray or csr.csr_matrix):
+        """
+        Cast the array to the storage data type
+        :param arr: dense or sparse array
+        :return: array in storage data type
+        """
+        if arr.dtype.kind in 'iu':
+            if self.storage_int_dtype is None:
+                return arr
+            dtype = self._int_dtype(arr)
+        elif arr.dtype.kind == 'f':
+            if self.storage_dtype is None:
+                return arr
+            dtype = self.storage_dtype
+            if isinstance(arr, csr.csr_matrix) and np.dtype(dtype) == np.float16:
+                dtype = np.float32
+        else:
+            raise TypeError('%s not supported' % arr.dtype)
+        return arr if arr.dtype == dtype else arr.astype(dtype)
+
+    def compute(self, arr: np.ndarray or csr.csr_matrix):
+        """
+        Cast the array or a block of it to the compute data type
+        :param arr: dense or sparse array
+        :return: array in compute data type
+        """
+        return arr if arr.dtype == self.compute_dtype else arr.astype(self.compute_dtype)
+
+    def l2_norm(self, mat: np.ndarray or csr.csr_matrix, block_size=1024):
+        """
+        Calculate the l2 norm of each vector in the matrix, accumulated in accumulate data type
+        :param mat: dense or sparse matrix, 2D
+        :param block_size: number of rows cast at once
+        :return: l2 norm array in compute data type
+        """
+        ret = np.empty(mat.shape[0], dtype=self.accumulate_dtype)
+        for start in range(0, mat.shape[0], block_size):
+            block = mat[start: start + block_size].astype(self.accumulate_dtype)
+            if isinstance(block, csr.csr_matrix):
+                ret[start: start + block_size] = np.asarray(block.multiply(block).sum(axis=1)).ravel()
+            else:
+                ret[start: start + block_size] = np.einsum('ij,ij->i', block, block)
+        return np.sqrt(ret).astype(self.compute_dtype)
+
+
+# Compact storage with float32 computation, the default when cast=True
+COMPACT_PRECISION = PrecisionPolicy()
+# Keep the input data type and compute in float64, the default when cast=False
+NATIVE_PRECISION = PrecisionPolicy(storage_dtype=None, compute_dtype=np.float64, accumulate_dtype=np.float64,
+                                   storage_int_dtype=None)
+
+
+def get_precision(precision: PrecisionPolicy or None, cast=True):
+    """
+    Resolve the precision policy of a cosine function
+    :param precision: precision policy, has priority over cast if not None
+    :param cast: whether to cast dtype to 16bit
+    :return: PrecisionPolicy
+    """
+    if precision is not None:
+        return precision
+    return COMPACT_PRECISION if cast else NATIVE_PRECISION
+
+
 # ==================================================================================================================== #
 # Numpy matrix part
 def cosine_distance(vec1: np.ndarray, vec2: np.ndarray):
@@ -55,35 +161,47 @@ def matrix_l2_norm(mat: np.ndarray):
     return np.linalg.norm(mat, 2, 1)
 
 
-def vec_mat_cosine(vec: np.ndarray, mat: np.ndarray, cast=True):
+def vec_mat_cosine(vec: np.ndarray, mat: np.ndarray, cast=True, precision: PrecisionPolicy = None, block_size=1024):
     """
     Calculate the cosine distance of the vector and each vector in the matrix
-    :param cast: whether to cast dtype to 16bit
+    :param cast: whether to cast dtype to 16bit, ignored if precision is given
     :param vec: vector, 1D array with shape (n,)
     :param mat: matrix, 2D array with shape (m, n)
+    :param precision: precision policy, see PrecisionPolicy
+    :param block_size: number of rows cast to compute data type at once
     :return: cosine distance of the vector and each vector in the matrix
     """
-    if cast:
-        vec = dtype_cast(vec)
-        mat = dtype_cast(mat)
-    vec_l2 = np.linalg.norm(vec, ord=2).astype(np.float16)
-    mat_l2 = matrix_l2_norm(mat).astype(np.float16)
-    return (vec_matrix_dot(vec, mat) / (vec_l2 * mat_l2))[0]
+    precision = get_precision(precision, cast)
+    vec = precision.compute(precision.store(vec))
+    mat = precision.store(mat)
+    dot_prod = np.empty(mat.shape[0], dtype=precision.compute_dtype)
+    for start in range(0, mat.shape[0], block_size):
+        dot_prod[start: start + block_size] = precision.compute(mat[start: start + block_size]).dot(vec)
+    vec_l2 = precision.l2_norm(np.array([vec]))[0]
+    return dot_prod / (vec_l2 * precision.l2_norm(mat, block_size))
 
 
-def mat_cosine(mat: np.ndarray, cast=True):
+def mat_cosine(mat: np.ndarray, cast=True, precision: PrecisionPolicy = None, block_size=1024):
     """
     Matrix as lines of vectors, calculate the cosine distance of every two vectors
-    :param cast: whether to cast dtype to 16bit
+    :param cast: whether to cast dtype to 16bit, ignored if precision is given
     :param mat: matrix
+    :param precision: precision policy, see PrecisionPolicy
+    :param block_size: size of the square tiles cast to compute data type at once
     :return: matrix, index i,j is the cosine distance of the i_th vector and j_th vector
     """
-    if cast:
-        mat = dtype_cast(mat)
-    mat_mat_dot = np.matmul(mat, mat.T)
-    mat_l2 = np.expand_dims(matrix_l2_norm(mat), axis=-1).astype(np.float16)
-    mat_l2 = np.matmul(mat_l2, mat_l2.T)
-    return mat_mat_dot/mat_l2
+    precision = get_precision(precision, cast)
+    mat = precision.store(mat)
+    num_vec = mat.shape[0]
+    mat_l2 = precision.l2_norm(mat, block_size)
+    ret = np.empty((num_vec, num_vec), dtype=precision.compute_dtype)
+    for row in range(0, num_vec, block_size):
+        row_block = precision.compute(mat[row: row + block_size])
+        for col in range(0, num_vec, block_size):
+            col_block = precision.compute(mat[col: col + block_size])
+            ret[row: row + block_size, col: col + block_size] = np.matmul(row_block, col_block.T)
+    ret /= np.outer(mat_l2, mat_l2)
+    return ret
 # ==================================================================================================================== #
 
 
@@ -109,14 +227,35 @@ def compressed_vec_cosine(vec1: dict, vec2: dict):
 def compressed_mat_cosine(vec: dict, mat: dict):
     """
     Calculate the cosine distance of the vector and each vector in the matrix
+    The matrix is converted into a sparse matrix once and scored with a single sparse production, see CompressedMatrix
     :param vec: vector
     :param mat: matrix
     :return: dict of cosine distance, {key: cosine distance}
     """
-    ret = dict()
-    for key, dic in mat.items():
-        ret[key] = compressed_vec_cosine(vec, dic)
-    return ret
+    return CompressedMatrix(mat).score(vec)
+
+
+def dict2sparse(mat: dict or list, vocab: pd.Index = None):
+    """
+    Convert a dict matrix into a sparse matrix
+    :param mat: {key: {element: weight}}, or a list of {element: weight}
+    :param vocab: element vocabulary, column j is the element vocab[j], elements not in it are dropped
+                  if None, built from the elements of the matrix
+    :return: csr_matrix, keys of the rows and the element vocabulary
+    """
+    keys = list(mat.keys()) if isinstance(mat, dict) else list(range(len(mat)))
+    vecs = list(mat.values()) if isinstance(mat, dict) else mat
+    lengths = np.fromiter((len(v) for v in vecs), dtype=np.int64, count=len(vecs))
+    elements = list(chain.from_iterable(v.keys() for v in vecs))
+    weights = np.fromiter(chain.from_iterable(v.values() for v in vecs), dtype=np.float64, count=len(elements))
+    if vocab is None:
+        codes, vocab = pd.factorize(pd.Series(elements, dtype=object))
+    else:
+        codes = vocab.get_indexer(pd.Series(elements, dtype=object))
+    rows = np.repeat(np.arange(len(vecs)), lengths)
+    known = codes >= 0
+    ret = csr_matrix((weights[known], (rows[known], codes[known])), shape=(len(vecs), len(vocab)))
+    return ret, keys, vocab
 # ==================================================================================================================== #
 
 
@@ -142,59 +281,1024 @@ def sparse_matrix_l2_norm(mat: csr.csr_matrix):
     return np.hstack(np.sqrt(dot_prod))
 
 
-def sparse_vec_mat_cosine(vec: csr.csr_matrix, mat: csr.csr_matrix, cast=True):
+def sparse_vec_mat_cosine(vec: csr.csr_matrix, mat: csr.csr_matrix, cast=True, precision: PrecisionPolicy = None,
+                          block_size=1024):
     """
     Calculate the cosine distance of the vector and each vector in the matrix
-    :param cast: whether to cast dtype to 16bit
+    :param cast: whether to cast dtype to 16bit, ignored if precision is given
     :param vec: vector, sparse array
     :param mat: matrix, sparse array
+    :param precision: precision policy, see PrecisionPolicy
+    :param block_size: number of rows cast to compute data type at once
     :return: cosine distance of the vector and each vector in the matrix
     """
-    if cast:
-        vec = dtype_cast(vec)
-        mat = dtype_cast(mat)
-    vec_l2 = sparse_matrix_l2_norm(vec)
-    return sparse_vec_mat_dot(vec, mat) / (vec_l2 * sparse_matrix_l2_norm(mat))
+    precision = get_precision(precision, cast)
+    vec = precision.compute(precision.store(vec))
+    mat = precision.store(mat)
+    vec_t = vec.T.tocsr()
+    dot_prod = np.empty(mat.shape[0], dtype=precision.compute_dtype)
+    for start in range(0, mat.shape[0], block_size):
+        dot_prod[start: start + block_size] = \
+            precision.compute(mat[start: start + block_size]).dot(vec_t).toarray().ravel()
+    vec_l2 = precision.l2_norm(vec)[0]
+    return dot_prod / (vec_l2 * precision.l2_norm(mat, block_size))
 
 
-def sparse_iter_mat_cosine(mat: csr_matrix, top_k=400, cast=True):
+def sparse_normalize(mat: csr.csr_matrix, dtype=np.float32):
     """
-    For each vector in the matrix, find the most similar top_k vectors.
-    :param cast: whether to cast dtype to 16bit
+    L2-normalize every vector in the sparse matrix, all-zero vectors stay zero
+    :param mat: matrix
+    :param dtype: data type of the normalized matrix
+    :return: normalized csr matrix, the dot production of two rows is their cosine distance
+    """
+    mat = csr_matrix(mat, dtype=dtype, copy=True)
+    mat_l2 = np.sqrt(np.asarray(mat.multiply(mat).sum(axis=1), dtype=dtype).ravel())
+    mat_l2[mat_l2 == 0] = 1
+    mat.data /= np.repeat(mat_l2, np.diff(mat.indptr))
+    return mat
+
+
+def top_k_select(scores: np.ndarray, top_k: int):
+    """
+    Select the top_k largest values of each row by partial selection, instead of a full sort
+    :param scores: 2D array with shape (m, n)
+    :param top_k: topK, should not be greater than n
+    :return: index array and score array with shape (m, top_k), each row in descending order of score
+    """
+    if top_k < scores.shape[1]:
+        index = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    else:
+        index = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    top_scores = np.take_along_axis(scores, index, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    return np.take_along_axis(index, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+def sparse_block_top_k(mat: csr.csr_matrix, top_k=400, block_size=1024, workers=1, return_score=False,
+                       dtype=np.float32):
+    """
+    For each vector in the matrix, find the most similar top_k vectors block by block.
+    The matrix is normalized once, then each block of rows is multiplied with the transposed matrix,
+    so the peak memory of a worker is bounded by a dense (block_size, num_vec) array.
     :param mat: matrix
     :param top_k: topK
+    :param block_size: number of rows in one block
+    :param workers: number of threads, the sparse production and partial selection run without the GIL
+    :param return_score: whether to return the cosine distance of the top_k vectors as well
+    :param dtype: compute data type
     :return: an array with shape (num_vec, top_k), each row is the index of the top_k vectors
+             if return_score, a tuple of the index array and the score array
     """
     num_vec = mat.shape[0]
-    if cast:
-        mat = dtype_cast(mat)
-    mat_l2 = sparse_matrix_l2_norm(mat)
-    ret = np.empty((num_vec, top_k), dtype=np.int32)
-    for i in tqdm(range(num_vec)):
-        vec = mat[i]
-        vec_l2 = sparse_matrix_l2_norm(vec)
-        cosine_vec = sparse_vec_mat_dot(vec, mat) / (vec_l2 * mat_l2)
-        ret[i] = np.argsort(cosine_vec)[:-top_k-1:-1]
-    return ret
+    norm_mat = sparse_normalize(mat, dtype=dtype)
+    index, scores = _sparse_rows_top_k(norm_mat, norm_mat.T.tocsr(), np.arange(num_vec), min(top_k, num_vec),
+                                       block_size, workers)
+    if return_score:
+        return index, scores
+    return index
+
+
+def _sparse_rows_top_k(norm_mat: csr.csr_matrix, norm_mat_t: csr.csr_matrix, rows: np.ndarray, top_k: int,
+                       block_size=1024, workers=1):
+    """
+    Top k most similar vectors of the given rows of a normalized matrix, computed block by block
+    :param norm_mat: normalized matrix
+    :param norm_mat_t: transpose of the normalized matrix, in csr format
+    :param rows: index of the query rows
+    :param top_k: topK, should not be greater than the number of vectors
+    :param block_size: number of rows in one block
+    :param workers: number of threads
+    :return: index array and score array with shape (len(rows), top_k)
+    """
+    def _block(start):
+        scores = norm_mat[rows[start: start + block_size]].dot(norm_mat_t).toarray()
+        return start, top_k_select(scores, top_k)
+
+    ret = np.empty((len(rows), top_k), dtype=np.int32)
+    ret_score = np.empty((len(rows), top_k), dtype=norm_mat.dtype)
+    starts = range(0, len(rows), block_size)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start, (index, scores) in tqdm(executor.map(_block, starts), total=len(starts)):
+            ret[start: start + len(index)] = index
+            ret_score[start: start + len(index)] = scores
+    return ret, ret_score
+
+
+def sparse_replace_rows(mat: csr.csr_matrix, rows, new_rows: csr.csr_matrix):
+    """
+    Replace rows of a sparse matrix without touching the other rows, rows beyond the matrix are appended
+    :param mat: matrix with shape (m, n)
+    :param rows: index of the replaced rows
+    :param new_rows: matrix with shape (len(rows), n)
+    :return: csr_matrix with shape (max(m, max(rows) + 1), n)
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    num_vec = max(mat.shape[0], int(rows.max()) + 1) if len(rows) else mat.shape[0]
+    if num_vec > mat.shape[0]:
+        mat = sparse_vstack([mat, csr_matrix((num_vec - mat.shape[0], mat.shape[1]), dtype=mat.dtype)])
+    keep = np.ones(num_vec, dtype=mat.dtype)
+    keep[rows] = 0
+    place = csr_matrix((np.ones(len(rows), dtype=mat.dtype), (rows, np.arange(len(rows)))),
+                       shape=(num_vec, len(rows)))
+    return csr_matrix(diags(keep).dot(mat) + place.dot(new_rows))
+
+
+def incremental_top_k(norm_mat: csr.csr_matrix, top_index: np.ndarray, top_score: np.ndarray,
+                      delta: csr.csr_matrix, delta_rows, block_size=1024, workers=1):
+    """
+    Update the top k table of sparse_iter_mat_cosine when some vectors of the matrix change.
+    Only two kinds of rows are recomputed against the whole matrix: the changed rows, and the rows whose stored
+    neighbours include a changed row (their old scores are no longer valid).
+    For every other row, the old neighbours keep their scores, and every unchanged vector outside of them scores no
+    more than the old k-th one, so merging the old neighbours with the changed vectors gives the new top k.
+    The result is the same as a full rebuild, except for the order of equal scores.
+    :param norm_mat: previous normalized matrix, see sparse_normalize
+    :param top_index: previous index array with shape (num_vec, top_k)
+    :param top_score: previous score array with shape (num_vec, top_k), see return_score of sparse_iter_mat_cosine
+    :param delta: new vectors of the changed rows, not normalized
+    :param delta_rows: index of the changed rows, index beyond the matrix appends new vectors
+    :param block_size: number of rows in one block
+    :param workers: number of threads
+    :return: new normalized matrix, new index array and new score array
+    """
+    delta_rows = np.asarray(delta_rows, dtype=np.int64)
+    norm_mat = sparse_replace_rows(norm_mat, delta_rows, sparse_normalize(delta, dtype=norm_mat.dtype))
+    norm_mat_t = norm_mat.T.tocsr()
+    num_vec, top_k = norm_mat.shape[0], top_index.shape[1]
+
+    ret = np.full((num_vec, top_k), -1, dtype=np.int32)
+    ret_score = np.full((num_vec, top_k), -np.inf, dtype=norm_mat.dtype)
+    ret[:len(top_index)] = top_index
+    ret_score[:len(top_score)] = top_score
+
+    changed = np.zeros(num_vec, dtype=bool)
+    changed[delta_rows] = True
+    affected = changed.copy()
+    affected[:len(top_index)] |= changed[top_index].any(axis=1)
+
+    # Rows keeping their old neighbours, merged with the new scores of the changed vectors
+    rest = np.flatnonzero(~affected)
+    changed_rows = np.flatnonzero(changed)
+    changed_t = norm_mat[changed_rows].T.tocsr()
+    for start in range(0, len(rest), block_size):
+        rows = rest[start: start + block_size]
+        scores = np.hstack([ret_score[rows], norm_mat[rows].dot(changed_t).toarray()])
+        index = np.hstack([ret[rows], np.broadcast_to(changed_rows.astype(np.int32), (len(rows), len(changed_rows)))])
+        select, ret_score[rows] = top_k_select(scores, top_k)
+        ret[rows] = np.take_along_axis(index, select, axis=1)
+
+    # Rows recomputed against the whole matrix
+    rows = np.flatnonzero(affected)
+    ret[rows], ret_score[rows] = _sparse_rows_top_k(norm_mat, norm_mat_t, rows, min(top_k, num_vec),
+                                                    block_size, workers)
+    return norm_mat, ret, ret_score
+
+
+def sparse_iter_mat_cosine(mat: csr_matrix, top_k=400, cast=True, block_size=1024, workers=1, return_score=False,
+                           precision: PrecisionPolicy = None):
+    """
+    For each vector in the matrix, find the most similar top_k vectors.
+    :param cast: whether to cast dtype to 16bit, ignored if precision is given
+    :param mat: matrix
+    :param top_k: topK
+    :param block_size: number of rows computed together, see sparse_block_top_k
+    :param workers: number of threads, see sparse_block_top_k
+    :param return_score: whether to return the score array as well
+    :param precision: precision policy, see PrecisionPolicy
+    :return: an array with shape (num_vec, top_k), each row is the index of the top_k vectors
+    """
+    precision = get_precision(precision, cast)
+    mat = precision.store(mat)
+    return sparse_block_top_k(mat, top_k=top_k, block_size=block_size, workers=workers, return_score=return_score,
+                              dtype=precision.compute_dtype)
 
 
-def sparse_mat_cosine(mat: csr.csr_matrix, cast=True):
+def sparse_mat_cosine(mat: csr.csr_matrix, cast=True, precision: PrecisionPolicy = None, block_size=1024):
     """
     Matrix as lines of vectors, calculate the cosine distance of every two vectors
-    :param cast: whether to cast dtype to 16bit
+    :param cast: whether to cast dtype to 16bit, ignored if precision is given
     :param mat: matrix
+    :param precision: precision policy, see PrecisionPolicy
+    :param block_size: number of rows computed together
     :return: matrix, index i,j is the cosine distance of the i_th vector and j_th vector
     """
-    if cast:
-        mat = dtype_cast(mat)
-    dot_prod = mat.dot(mat.T)
-    mat_l2 = np.sqrt(mat.power(2).sum(axis=1)).astype(np.float16)
-    mat_l2 = np.dot(mat_l2, mat_l2.T)
-    return np.array(dot_prod / mat_l2)
+    precision = get_precision(precision, cast)
+    norm_mat = sparse_normalize(precision.store(mat), dtype=precision.compute_dtype)
+    norm_mat_t = norm_mat.T.tocsr()
+    ret = np.empty((mat.shape[0], mat.shape[0]), dtype=precision.compute_dtype)
+    for start in range(0, mat.shape[0], block_size):
+        ret[start: start + block_size] = norm_mat[start: start + block_size].dot(norm_mat_t).toarray()
+    return ret
 
 # ==================================================================================================================== #
 
 
+# ==================================================================================================================== #
+# Interaction matrix part
+class InteractionMatrixBuilder:
+    """
+    Build a (row id, column id) sparse matrix from a long format DataFrame like (user_id, op_code, qty).
+    Ids are encoded with mapping.Encoder vocabularies which can be reused across jobs, and duplicated pairs are summed.
+    Rows with a null id are skipped.
+
+    >>> builder = InteractionMatrixBuilder('user_id', 'op_code', 'qty')
+    >>> mat = builder.fit(pd.read_csv(fn, chunksize=1000000))
+    >>> builder.save('user_op.npz')
+    >>> builder = InteractionMatrixBuilder.load('user_op.npz')
+    """
+
+    def __init__(self, row_key='user_id', col_key='op_code', target_key='qty', row_vocab=None, col_vocab=None,
+                 dtype=np.float32):
+        """
+        :param row_key: column of the row ids
+        :param col_key: column of the column ids
+        :param target_key: column of the values, None to count the interactions
+        :param row_vocab: existing row id vocabulary, extended with the unseen ids
+        :param col_vocab: existing column id vocabulary, extended with the unseen ids
+        :param dtype: data type of the matrix
+        """
+        self.row_key = row_key
+        self.col_key = col_key
+        self.target_key = target_key
+        self.row_encoder = Encoder(row_vocab)
+        self.col_encoder = Encoder(col_vocab)
+        self.dtype = dtype
+        self.matrix = csr_matrix((len(self.row_vocab), len(self.col_vocab)), dtype=dtype)
+
+    @property
+    def row_vocab(self):
+        return self.row_encoder.vocab
+
+    @property
+    def col_vocab(self):
+        return self.col_encoder.vocab
+
+    def partial_fit(self, df: pd.DataFrame):
+        """
+        Add the interactions of one DataFrame to the matrix
+        :param df: long format DataFrame
+        :return: self
+        """
+        valid = df[self.row_key].notna() & df[self.col_key].notna()
+        if not valid.all():
+            df = df[valid]
+        rows = self.row_encoder.transform(df[self.row_key].to_numpy(), unseen='extend')
+        cols = self.col_encoder.transform(df[self.col_key].to_numpy(), unseen='extend')
+        if self.target_key is None:
+            vals = np.ones(len(df), dtype=self.dtype)
+        else:
+            vals = df[self.target_key].values.astype(self.dtype)
+        shape = (len(self.row_vocab), len(self.col_vocab))
+        self.matrix.resize(shape)
+        self.matrix = self.matrix + csr_matrix((vals, (rows, cols)), shape=shape, dtype=self.dtype)
+        return self
+
+    def fit(self, data: pd.DataFrame or iter):
+        """
+        Build the matrix from a DataFrame or an iterator of DataFrames, e.g. pd.read_csv(..., chunksize=...)
+        :param data: DataFrame or iterator of DataFrames
+        :return: csr_matrix
+        """
+        if isinstance(data, pd.DataFrame):
+            data = [data]
+        for df in tqdm(data):
+            self.partial_fit(df)
+        return self.matrix
+
+    def transform_ids(self, row_ids=None, col_ids=None):
+        """
+        Encode ids with the vocabularies, unknown ids are encoded as -1
+        :param row_ids: array-like of row ids
+        :param col_ids: array-like of column ids
+        :return: code arrays of the given ids
+        """
+        ret = []
+        if row_ids is not None:
+            ret.append(self.row_encoder.get_indexer(row_ids))
+        if col_ids is not None:
+            ret.append(self.col_encoder.get_indexer(col_ids))
+        return ret[0] if len(ret) == 1 else tuple(ret)
+
+    def save(self, fp: str):
+        """
+        Save the matrix and the id vocabularies into a .npz file
+        :param fp: file path
+        :return: None
+        """
+        vocabs = {}
+        for name, vocab in (('row_vocab', self.row_vocab), ('col_vocab', self.col_vocab)):
+            vocab = vocab.to_numpy()
+            vocabs[name] = vocab.astype(str) if vocab.dtype == object else vocab
+        np.savez(fp, data=self.matrix.data, indices=self.matrix.indices, indptr=self.matrix.indptr,
+                 shape=self.matrix.shape, keys=[self.row_key, self.col_key, self.target_key or ''], **vocabs)
+
+    @classmethod
+    def load(cls, fp: str):
+        """
+        Load the matrix and the id vocabularies from a .npz file
+        :param fp: file path
+        :return: InteractionMatrixBuilder
+        """
+        with np.load(fp) as npz:
+            row_key, col_key, target_key = npz['keys'].tolist()
+            builder = cls(row_key, col_key, target_key or None, row_vocab=npz['row_vocab'],
+                          col_vocab=npz['col_vocab'], dtype=npz['data'].dtype)
+            builder.matrix = csr_matrix((npz['data'], npz['indices'], npz['indptr']), shape=tuple(npz['shape']))
+        return builder
+# ==================================================================================================================== #
+
+
+# ==================================================================================================================== #
+# Similarity index part
+class SimilarityIndex:
+    """
+    Hold the L2-normalized matrix and the norms of its vectors, so that scoring many query vectors against the same
+    matrix does not recompute them. Dense matrices stay dense, other matrices are kept as csr_matrix.
+
+    >>> index = SimilarityIndex(item_mat)
+    >>> index.score(user_vec)
+    >>> index.topk_batch(user_mat, k=10)
+    >>> index.append(new_item_mat)
+    >>> index.update([3, 5], changed_item_mat)
+    """
+
+    def __init__(self, mat: np.ndarray or csr.csr_matrix, cast=True, precision: PrecisionPolicy = None):
+        self.precision = get_precision(precision, cast)
+        self.dense = isinstance(mat, np.ndarray)
+        self._norm_mat, self.norms = self._normalize(mat)
+        self._pending = []
+        self._norm_mat_t = None
+
+    @property
+    def shape(self):
+        return self.norms.shape[0], self._norm_mat.shape[1]
+
+    def _normalize(self, mat: np.ndarray or csr.csr_matrix):
+        """
+        Normalize the vectors of the matrix in compute data type
+        :return: normalized matrix and l2 norms
+        """
+        if self.dense:
+            # Sparse queries and appended rows are densified to match the index
+            mat = mat.toarray() if issparse(mat) else mat
+            mat = self.precision.store(np.atleast_2d(np.asarray(mat)))
+            norms = self.precision.l2_norm(mat)
+            return _normalized_block(mat, norms, 0, mat.shape[0], self.precision), norms
+        mat = self.precision.store(csr_matrix(mat))
+        norms = self.precision.l2_norm(mat)
+        return sparse_normalize(mat, dtype=self.precision.compute_dtype), norms
+
+    @property
+    def norm_mat(self):
+        """
+        The normalized matrix, appended rows are merged into it at the first access
+        """
+        if self._pending:
+            stack = np.vstack if self.dense else sparse_vstack
+            self._norm_mat = stack([self._norm_mat] + self._pending)
+            if not self.dense:
+                self._norm_mat = csr_matrix(self._norm_mat)
+            self._pending = []
+            self._norm_mat_t = None
+        return self._norm_mat
+
+    @property
+    def norm_mat_t(self):
+        """
+        Transpose of the normalized matrix, cached for the sparse production
+        """
+        norm_mat = self.norm_mat
+        if self._norm_mat_t is None:
+            self._norm_mat_t = norm_mat.T if self.dense else norm_mat.T.tocsr()
+        return self._norm_mat_t
+
+    def score_batch(self, mat: np.ndarray or csr.csr_matrix):
+        """
+        Cosine distance of each query vector and each vector in the index
+        :param mat: query matrix with shape (q, n)
+        :return: array with shape (q, m)
+        """
+        query, _ = self._normalize(mat)
+        scores = query.dot(self.norm_mat_t)
+        return scores.toarray() if isinstance(scores, csr.csr_matrix) else np.asarray(scores)
+
+    def score(self, vec: np.ndarray or csr.csr_matrix):
+        """
+        Cosine distance of the query vector and each vector in the index
+        :param vec: vector, 1D array with shape (n,) or sparse vector
+        :return: array with shape (m,)
+        """
+        return self.score_batch(vec)[0]
+
+    def topk_batch(self, mat: np.ndarray or csr.csr_matrix, k=10, block_size=1024):
+        """
+        For each query vector, find the most similar k vectors in the index
+        :param mat: query matrix with shape (q, n)
+        :param k: topK
+        :param block_size: number of query vectors scored together
+        :return: index array and score array with shape (q, k), each row in descending order of score
+        """
+        k = min(k, self.shape[0])
+        ret = np.empty((mat.shape[0], k), dtype=np.int32)
+        ret_score = np.empty((mat.shape[0], k), dtype=self.precision.compute_dtype)
+        for start in range(0, mat.shape[0], block_size):
+            index, scores = top_k_select(self.score_batch(mat[start: start + block_size]), k)
+            ret[start: start + block_size] = index
+            ret_score[start: start + block_size] = scores
+        return ret, ret_score
+
+    def append(self, mat: np.ndarray or csr.csr_matrix):
+        """
+        Append vectors to the index, only the new vectors are normalized
+        :param mat: matrix with shape (a, n)
+        :return: index of the appended vectors
+        """
+        norm_mat, norms = self._normalize(mat)
+        start = self.shape[0]
+        self._pending.append(norm_mat)
+        self.norms = np.concatenate([self.norms, norms])
+        return np.arange(start, start + norm_mat.shape[0])
+
+    def update(self, index, mat: np.ndarray or csr.csr_matrix):
+        """
+        Replace vectors of the index, only the new vectors are normalized
+        :param index: index of the replaced vectors
+        :param mat: matrix with shape (len(index), n)
+        :return: None
+        """
+        index = np.asarray(index, dtype=np.int64)
+        norm_mat, norms = self._normalize(mat)
+        if self.dense:
+            self.norm_mat[index] = norm_mat
+        else:
+            self._norm_mat = sparse_replace_rows(self.norm_mat, index, norm_mat)
+        self.norms[index] = norms
+        self._norm_mat_t = None
+
+
+class CompressedMatrix:
+    """
+    Dict matrix {key: {element: weight}} converted once into a SimilarityIndex over a shared element vocabulary.
+
+    >>> cm = CompressedMatrix({'a': {1: 1, 2: 2}, 'b': {2: 3, 4: 1}})
+    >>> cm.score({1: 1, 3: 2})
+    {'a': 0.2, 'b': 0.0}
+    """
+
+    def __init__(self, mat: dict, cast=False, precision: PrecisionPolicy = None):
+        sparse_mat, self.keys, self.vocab = dict2sparse(mat)
+        self.index = SimilarityIndex(sparse_mat, cast=cast, precision=precision)
+
+    def score_batch(self, vecs: list):
+        """
+        Cosine distance of each dict vector and each vector in the matrix
+        Elements out of the vocabulary add nothing to the dot production but still count in the l2 norm of the vector
+        :param vecs: list of {element: weight}
+        :return: array with shape (len(vecs), len(keys)), columns in the order of keys
+        """
+        query, _, _ = dict2sparse(vecs, self.vocab)
+        query_l2 = np.sqrt(np.fromiter((sum(w * w for w in v.values()) for v in vecs), dtype=np.float64,
+                                       count=len(vecs)))
+        query_l2[query_l2 == 0] = 1
+        query = self.index.precision.compute(query)
+        scores = query.dot(self.index.norm_mat_t).toarray()
+        return scores / query_l2[:, None]
+
+    def score(self, vec: dict):
+        """
+        Cosine distance of the dict vector and each vector in the matrix
+        :param vec: {element: weight}
+        :return: dict of cosine distance, {key: cosine distance}
+        """
+        return dict(zip(self.keys, self.score_batch([vec])[0].tolist()))
+# ==================================================================================================================== #
+
+
+# ==================================================================================================================== #
+# Recommendation part
+def recommend_top_n(history: csr.csr_matrix, item_sim: np.ndarray or csr.csr_matrix, top_n=10, block_size=4096,
+                    workers=1, mask_history=True, fp=None):
+    """
+    Score items for each user by the similarity of the items to the user history, and keep the top_n items.
+    The score of item j for user u is the dot production of the history of u and the similarity vector of item j.
+    Users are processed by blocks on a thread pool, the peak memory of a worker is a dense (block_size, num_item)
+    array, and with fp the results are written into .npy files on disk instead of memory.
+    :param history: user-item matrix with shape (num_user, num_item), e.g. from InteractionMatrixBuilder
+    :param item_sim: item-item similarity matrix with shape (num_item, num_item), dense or sparse,
+                     e.g. from sparse_mat_cosine or load_similarity_store
+    :param top_n: number of items of each user
+    :param block_size: number of users in one block
+    :param workers: number of threads
+    :param mask_history: whether to exclude the items in the history of the user
+    :param fp: path prefix of the result files {fp}_items.npy and {fp}_scores.npy, None to keep them in memory
+    :return: int32 item index array and float32 score array with shape (num_user, top_n), each row in descending
+             order of score, padded with -1 and nan if the user has less than top_n items of positive score
+    """
+    history = csr_matrix(history)
+    if isinstance(item_sim, np.ndarray):
+        item_sim = item_sim.astype(np.float32, copy=False)
+    else:
+        item_sim = csr_matrix(item_sim, dtype=np.float32)
+    num_user, num_item = history.shape
+    top_n = min(top_n, num_item)
+    shape = (num_user, top_n)
+    if fp is None:
+        ret = np.empty(shape, dtype=np.int32)
+        ret_score = np.empty(shape, dtype=np.float32)
+    else:
+        ret = np.lib.format.open_memmap('%s_items.npy' % fp, mode='w+', dtype=np.int32, shape=shape)
+        ret_score = np.lib.format.open_memmap('%s_scores.npy' % fp, mode='w+', dtype=np.float32, shape=shape)
+
+    def _block(start):
+        block = history[start: start + block_size].astype(np.float32)
+        scores = block.dot(item_sim)
+        scores = scores.toarray() if isinstance(scores, csr.csr_matrix) else np.asarray(scores)
+        if mask_history:
+            block = block.tocoo()
+            scores[block.row, block.col] = -np.inf
+        index, scores = top_k_select(scores, top_n)
+        # Items without a positive score, e.g. all the items of a user with an empty history, are no candidates
+        invalid = ~(scores > 0)
+        index[invalid] = -1
+        scores[invalid] = np.nan
+        ret[start: start + block_size] = index
+        ret_score[start: start + block_size] = scores
+
+    starts = range(0, num_user, block_size)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(tqdm(executor.map(_block, starts), total=len(starts)))
+    if fp is not None:
+        ret.flush()
+        ret_score.flush()
+    return ret, ret_score
+
+
+def top_n_to_df(index: np.ndarray, scores: np.ndarray, user_vocab=None, item_vocab=None,
+                user_col='user_id', item_col='op_code', score_col='score'):
+    """
+    Convert the result of recommend_top_n into a long format DataFrame
+    :param index: item index array with shape (num_user, top_n)
+    :param scores: score array with shape (num_user, top_n)
+    :param user_vocab: user ids, row i is the user user_vocab[i], None to keep the row index
+    :param item_vocab: item ids, index j is the item item_vocab[j], None to keep the item index
+    :param user_col: name of the user column
+    :param item_col: name of the item column
+    :param score_col: name of the score column
+    :return: DataFrame of (user_col, item_col, score_col, rank), padding removed, rank starts from 1
+    """
+    valid = index >= 0
+    users = np.broadcast_to(np.arange(index.shape[0])[:, None], index.shape)[valid]
+    items = index[valid]
+    ranks = np.broadcast_to(np.arange(1, index.shape[1] + 1, dtype=np.int32), index.shape)[valid]
+    return pd.DataFrame({
+        user_col: users if user_vocab is None else np.asarray(user_vocab)[users],
+        item_col: items if item_vocab is None else np.asarray(item_vocab)[items],
+        score_col: scores[valid],
+        'rank': ranks,
+    })
+# ==================================================================================================================== #
+
+
+# ==================================================================================================================== #
+# Neighbour table part
+# File layout: magic | uint64 header length | json header | padding | int32 index block | score block
+NEIGHBOUR_TABLE_MAGIC = b'BDSNBT01'
+_NEIGHBOUR_TABLE_ALIGN = 64
+
+
+def save_neighbour_table(fp: str, index: np.ndarray, scores: np.ndarray = None, ids=None, score_dtype='float16'):
+    """
+    Save a top k table, e.g. the result of sparse_iter_mat_cosine, into a file which can be memory-mapped
+    :param fp: file path
+    :param index: index array with shape (num_vec, top_k), padded with -1
+    :param scores: score array with shape (num_vec, top_k), None to save the index only
+    :param ids: id of each vector, row i of the table belongs to ids[i], None to use the row number
+    :param score_dtype: 'float16', or 'int8' to quantize the scores linearly by the max absolute score
+    :return: None
+    """
+    if score_dtype not in ('float16', 'int8'):
+        raise ValueError('score_dtype %s not supported' % score_dtype)
+    index = np.ascontiguousarray(index, dtype=np.int32)
+    header = {'num_vec': index.shape[0], 'top_k': index.shape[1], 'score_dtype': None, 'scale': 1.0,
+              'ids': None if ids is None else np.asarray(ids).tolist()}
+    if scores is not None:
+        scores = np.asarray(scores, dtype=np.float32)
+        header['score_dtype'] = score_dtype
+        if score_dtype == 'int8':
+            # -128 is kept for the padding
+            finite = np.isfinite(scores)
+            max_abs = np.abs(scores[finite]).max() if finite.any() else 1.0
+            header['scale'] = float(max_abs / 127) or 1.0
+            quantized = np.round(np.where(finite, scores, 0) / header['scale'])
+            scores = np.where(finite, quantized, -128).astype(np.int8)
+        else:
+            scores = scores.astype(np.float16)
+    header = json.dumps(header).encode('utf-8')
+    offset = len(NEIGHBOUR_TABLE_MAGIC) + 8 + len(header)
+    padding = -offset % _NEIGHBOUR_TABLE_ALIGN
+    with open(fp, 'wb') as fout:
+        fout.write(NEIGHBOUR_TABLE_MAGIC)
+        fout.write(np.uint64(len(header)).tobytes())
+        fout.write(header)
+        fout.write(b'\0' * padding)
+        fout.write(index.tobytes())
+        if scores is not None:
+            fout.write(np.ascontiguousarray(scores).tobytes())
+
+
+class NeighbourTable:
+    """
+    Memory-mapped top k table saved by save_neighbour_table, only the header is read when opened,
+    the rows are read from the page cache on lookup.
+
+    >>> table = NeighbourTable('item_top_k.nbt')
+    >>> table.neighbours('P123456')
+    >>> table.batch_neighbours(['P123456', 'P654321'])
+    """
+
+    def __init__(self, fp: str):
+        with open(fp, 'rb') as fin:
+            if fin.read(len(NEIGHBOUR_TABLE_MAGIC)) != NEIGHBOUR_TABLE_MAGIC:
+                raise ValueError('%s is not a neighbour table' % fp)
+            header_len = int(np.frombuffer(fin.read(8), dtype=np.uint64)[0])
+            header = json.loads(fin.read(header_len).decode('utf-8'))
+        offset = len(NEIGHBOUR_TABLE_MAGIC) + 8 + header_len
+        offset += -offset % _NEIGHBOUR_TABLE_ALIGN
+        shape = (header['num_vec'], header['top_k'])
+        self.shape = shape
+        self.ids = None if header['ids'] is None else pd.Index(header['ids'])
+        self.index = np.memmap(fp, dtype=np.int32, mode='r', offset=offset, shape=shape) if shape[0] else \
+            np.empty(shape, dtype=np.int32)
+        self.score_dtype = header['score_dtype']
+        self.scale = header['scale']
+        self.scores = None
+        if self.score_dtype is not None and shape[0]:
+            self.scores = np.memmap(fp, dtype=self.score_dtype, mode='r', offset=offset + self.index.nbytes,
+                                    shape=shape)
+
+    def _rows(self, keys):
+        if self.ids is None:
+            rows = np.asarray(keys, dtype=np.int64)
+            return np.where((rows >= 0) & (rows < self.shape[0]), rows, -1)
+        return self.ids.get_indexer(keys)
+
+    def _decode(self, scores: np.ndarray):
+        if self.score_dtype == 'int8':
+            return np.where(scores == -128, np.nan, scores * np.float32(self.scale)).astype(np.float32)
+        return scores.astype(np.float32)
+
+    def batch_neighbours(self, keys):
+        """
+        Neighbours of several ids
+        :param keys: list of ids
+        :return: int32 array of neighbour rows with shape (len(keys), top_k) and float32 score array (None if no
+                 scores are saved), padded with -1 and nan, unknown ids give a row of padding.
+                 use ids[rows] to get the neighbour ids
+        """
+        rows = self._rows(keys)
+        known = rows >= 0
+        index = np.full((len(rows), self.shape[1]), -1, dtype=np.int32)
+        index[known] = self.index[rows[known]]
+        if self.scores is None:
+            return index, None
+        scores = np.full(index.shape, np.nan, dtype=np.float32)
+        scores[known] = self._decode(self.scores[rows[known]])
+        return index, scores
+
+    def neighbours(self, key):
+        """
+        Neighbours of one id
+        :param key: id
+        :return: list of neighbour ids and float32 score array (None if no scores are saved), padding removed
+        """
+        rows = self._rows([key])
+        if rows[0] < 0:
+            raise KeyError(key)
+        index = np.asarray(self.index[rows[0]])
+        valid = index >= 0
+        ids = index[valid].tolist() if self.ids is None else self.ids[index[valid]].tolist()
+        if self.scores is None:
+            return ids, None
+        return ids, self._decode(np.asarray(self.scores[rows[0]]))[valid]
+# ==================================================================================================================== #
+
+
+# ==================================================================================================================== #
+# Out-of-core part
+def _normalized_block(mat: np.ndarray or csr.csr_matrix, mat_l2: np.ndarray, start: int, block_size: int,
+                      precision: PrecisionPolicy):
+    """
+    A block of rows of the matrix, cast to compute data type and L2-normalized
+    """
+    block = precision.compute(mat[start: start + block_size])
+    block_l2 = mat_l2[start: start + block_size].copy()
+    block_l2[block_l2 == 0] = 1
+    if isinstance(block, csr.csr_matrix):
+        return csr_matrix(block.multiply(1 / block_l2[:, None]))
+    return block / block_l2[:, None]
+
+
+def _tile_dot(row_block: np.ndarray or csr.csr_matrix, col_block: np.ndarray or csr.csr_matrix):
+    if isinstance(row_block, csr.csr_matrix):
+        return row_block.dot(col_block.T).toarray()
+    return np.matmul(row_block, col_block.T)
+
+
+def _threshold_block(mat, mat_l2, row_block, threshold, block_size, precision):
+    """
+    Entries of a block of rows of the similarity matrix not less than threshold
+    :return: csr_matrix with shape (block rows, num_vec)
+    """
+    rows, cols, vals = [], [], []
+    for col in range(0, mat.shape[0], block_size):
+        scores = _tile_dot(row_block, _normalized_block(mat, mat_l2, col, block_size, precision))
+        row_index, col_index = np.nonzero(scores >= threshold)
+        rows.append(row_index)
+        cols.append(col_index + col)
+        vals.append(scores[row_index, col_index])
+    return csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                      shape=(row_block.shape[0], mat.shape[0]))
+
+
+def _top_k_block(mat, mat_l2, row_block, top_k, threshold, block_size, precision):
+    """
+    Top k entries of a block of rows of the similarity matrix, merged tile by tile
+    :return: csr_matrix with shape (block rows, num_vec)
+    """
+    num_rows = row_block.shape[0]
+    best_index = np.empty((num_rows, 0), dtype=np.int32)
+    best_score = np.empty((num_rows, 0), dtype=precision.compute_dtype)
+    for col in range(0, mat.shape[0], block_size):
+        scores = _tile_dot(row_block, _normalized_block(mat, mat_l2, col, block_size, precision))
+        index = np.broadcast_to(np.arange(col, col + scores.shape[1], dtype=np.int32), scores.shape)
+        scores = np.hstack([best_score, scores])
+        index = np.hstack([best_index, index])
+        select, best_score = top_k_select(scores, min(top_k, scores.shape[1]))
+        best_index = np.take_along_axis(index, select, axis=1)
+    mask = np.ones(best_score.shape, dtype=bool) if threshold is None else best_score >= threshold
+    rows = np.broadcast_to(np.arange(num_rows)[:, None], best_index.shape)
+    return csr_matrix((best_score[mask], (rows[mask], best_index[mask])), shape=(num_rows, mat.shape[0]))
+
+
+def tiled_mat_cosine(mat: np.ndarray or csr.csr_matrix, fp: str, top_k=None, threshold=None, block_size=1024,
+                     cast=True, precision: PrecisionPolicy = None):
+    """
+    Out-of-core version of mat_cosine and sparse_mat_cosine.
+    The similarity matrix is computed tile by tile, only the top_k and/or above-threshold entries of each row are
+    kept, and they are appended to a CSR store on disk, see load_similarity_store.
+    The peak memory is bounded by a few (block_size, block_size) tiles, the full result is never materialized.
+    :param mat: matrix, dense or sparse array with shape (m, n)
+    :param fp: directory of the similarity store
+    :param top_k: number of entries kept in each row, None for no limit
+    :param threshold: minimum cosine distance of the kept entries, None for no limit
+    :param block_size: size of the square tiles
+    :param cast: whether to cast dtype to 16bit, ignored if precision is given
+    :param precision: precision policy, see PrecisionPolicy
+    :return: number of stored entries
+    """
+    if top_k is None and threshold is None:
+        raise ValueError('At least one of top_k and threshold should be given')
+    precision = get_precision(precision, cast)
+    if isinstance(mat, csr.csr_matrix) or not isinstance(mat, np.ndarray):
+        mat = csr_matrix(mat)
+    mat = precision.store(mat)
+    num_vec = mat.shape[0]
+    mat_l2 = precision.l2_norm(mat, block_size)
+
+    os.makedirs(fp, exist_ok=True)
+    indptr = np.zeros(num_vec + 1, dtype=np.int64)
+    with open(os.path.join(fp, 'data.bin'), 'wb') as data_out, \
+            open(os.path.join(fp, 'indices.bin'), 'wb') as indices_out:
+        for row in tqdm(range(0, num_vec, block_size)):
+            row_block = _normalized_block(mat, mat_l2, row, block_size, precision)
+            if top_k is None:
+                block = _threshold_block(mat, mat_l2, row_block, threshold, block_size, precision)
+            else:
+                block = _top_k_block(mat, mat_l2, row_block, top_k, threshold, block_size, precision)
+            indptr[row + 1: row + block.shape[0] + 1] = indptr[row] + block.indptr[1:]
+            data_out.write(block.data.astype(np.float32).tobytes())
+            indices_out.write(block.indices.astype(np.int32).tobytes())
+
+    np.save(os.path.join(fp, 'indptr.npy'), indptr)
+    with open(os.path.join(fp, 'meta.json'), 'w', encoding='utf-8') as fout:
+        json.dump({'shape': [num_vec, num_vec], 'nnz': int(indptr[-1]), 'top_k': top_k, 'threshold': threshold},
+                  fout)
+    return int(indptr[-1])
+
+
+def load_similarity_store(fp: str, mmap=True):
+    """
+    Open a similarity store written by tiled_mat_cosine
+    :param fp: directory of the similarity store
+    :param mmap: whether to memory-map the files instead of reading them, the result shares the page cache
+    :return: csr_matrix, index i,j is the cosine distance of the i_th vector and j_th vector if stored
+    """
+    with open(os.path.join(fp, 'meta.json'), 'r', encoding='utf-8') as fin:
+        meta = json.load(fin)
+    if mmap and meta['nnz'] > 0:
+        data = np.memmap(os.path.join(fp, 'data.bin'), dtype=np.float32, mode='r')
+        indices = np.memmap(os.path.join(fp, 'indices.bin'), dtype=np.int32, mode='r')
+    else:
+        data = np.fromfile(os.path.join(fp, 'data.bin'), dtype=np.float32)
+        indices = np.fromfile(os.path.join(fp, 'indices.bin'), dtype=np.int32)
+    indptr = np.load(os.path.join(fp, 'indptr.npy'), mmap_mode='r' if mmap else None)
+    return csr_matrix((data, indices, indptr), shape=tuple(meta['shape']), copy=False)
+# ==================================================================================================================== #
+
+
+# ==================================================================================================================== #
+# Approximate nearest neighbour part
+class LSHIndex:
+    """
+    Random-hyperplane LSH index for cosine similarity.
+
+    Each vector is hashed by the signs of its projections on num_bits random hyperplanes, once per table.
+    A query collects the vectors sharing a bucket with it in any table, then re-ranks these candidates by the
+    exact cosine distance. More bits give smaller buckets (faster, lower recall), more tables give higher recall.
+
+    >>> index = LSHIndex(num_bits=12, num_tables=8, seed=0).build(mat)
+    >>> index.query(mat[0], k=10)
+    >>> index.batch_query(mat[:100], k=10)
+    """
+
+    def __init__(self, num_bits=16, num_tables=8, seed=None, block_size=65536):
+        if not 0 < num_bits <= 62:
+            raise ValueError('num_bits should be in [1, 62], got %s' % num_bits)
+        self.num_bits = num_bits
+        self.num_tables = num_tables
+        self.seed = seed
+        self.block_size = block_size
+        self.planes = None
+        self.norm_mat = None
+        self.keys = None
+        self.orders = None
+
+    def _hash(self, norm_mat: csr.csr_matrix):
+        """
+        Hash keys of each vector in each table
+        :param norm_mat: normalized matrix with shape (m, n)
+        :return: int64 array with shape (num_tables, m)
+        """
+        powers = 2 ** np.arange(self.num_bits, dtype=np.int64)
+        keys = np.empty((self.num_tables, norm_mat.shape[0]), dtype=np.int64)
+        for start in range(0, norm_mat.shape[0], self.block_size):
+            proj = norm_mat[start: start + self.block_size].dot(self.planes)
+            bits = (proj.reshape(-1, self.num_tables, self.num_bits) > 0).astype(np.int64)
+            keys[:, start: start + self.block_size] = bits.dot(powers).T
+        return keys
+
+    def build(self, mat: np.ndarray or csr.csr_matrix):
+        """
+        Build the index
+        :param mat: matrix, dense or sparse array with shape (m, n)
+        :return: self
+        """
+        rng = np.random.default_rng(self.seed)
+        self.norm_mat = sparse_normalize(csr_matrix(mat))
+        self.planes = rng.standard_normal(
+            (mat.shape[1], self.num_tables * self.num_bits)).astype(np.float32)
+        keys = self._hash(self.norm_mat)
+        self.orders = np.argsort(keys, axis=1, kind='stable').astype(np.int32)
+        self.keys = np.take_along_axis(keys, self.orders, axis=1)
+        return self
+
+    def _candidates(self, keys: np.ndarray):
+        """
+        Index of the vectors in the same buckets
+        :param keys: hash keys of one query, with shape (num_tables,)
+        :return: unique index array
+        """
+        candidates = []
+        for table, key in enumerate(keys):
+            left, right = np.searchsorted(self.keys[table], [key, key + 1])
+            candidates.append(self.orders[table, left: right])
+        return np.unique(np.concatenate(candidates))
+
+    def batch_query(self, mat: np.ndarray or csr.csr_matrix, k=10):
+        """
+        Approximate top k most similar vectors of each query vector
+        :param mat: query matrix with shape (q, n)
+        :param k: topK
+        :return: index array with shape (q, k) padded with -1 and float32 score array padded with nan,
+                 each row in descending order of cosine distance
+        """
+        norm_query = sparse_normalize(csr_matrix(mat))
+        keys = self._hash(norm_query)
+        ret = np.full((norm_query.shape[0], k), -1, dtype=np.int32)
+        ret_score = np.full((norm_query.shape[0], k), np.nan, dtype=np.float32)
+        for i in range(norm_query.shape[0]):
+            candidates = self._candidates(keys[:, i])
+            if len(candidates) == 0:
+                continue
+            scores = norm_query[i].dot(self.norm_mat[candidates].T).toarray()
+            index, scores = top_k_select(scores, min(k, len(candidates)))
+            ret[i, :index.shape[1]] = candidates[index[0]]
+            ret_score[i, :index.shape[1]] = scores[0]
+        return ret, ret_score
+
+    def query(self, vec: np.ndarray or csr.csr_matrix, k=10):
+        """
+        Approximate top k most similar vectors of the query vector
+        :param vec: vector, 1D array with shape (n,) or sparse vector
+        :param k: topK
+        :return: index array and score array with shape (k,), see batch_query
+        """
+        if isinstance(vec, np.ndarray) and vec.ndim == 1:
+            vec = np.array([vec])
+        ret, ret_score = self.batch_query(vec, k)
+        return ret[0], ret_score[0]
+
+    def save(self, fp: str):
+        """
+        Save the index into a .npz file
+        :param fp: file path
+        :return: None
+        """
+        np.savez(fp, num_bits=self.num_bits, num_tables=self.num_tables, planes=self.planes,
+                 keys=self.keys, orders=self.orders, shape=self.norm_mat.shape, data=self.norm_mat.data,
+                 indices=self.norm_mat.indices, indptr=self.norm_mat.indptr)
+
+    @classmethod
+    def load(cls, fp: str):
+        """
+        Load the index from a .npz file
+        :param fp: file path
+        :return: LSHIndex
+        """
+        with np.load(fp) as npz:
+            index = cls(num_bits=int(npz['num_bits']), num_tables=int(npz['num_tables']))
+            index.planes = npz['planes']
+            index.keys = npz['keys']
+            index.orders = npz['orders']
+            index.norm_mat = csr_matrix((npz['data'], npz['indices'], npz['indptr']), shape=tuple(npz['shape']))
+        return index
+
+
+def ann_recall_report(index: LSHIndex, mat: csr.csr_matrix, k=10, exact=None):
+    """
+    Recall of the approximate index against the exact result of sparse_iter_mat_cosine
+    :param index: index built from mat
+    :param mat: matrix, each vector is used as a query
+    :param k: topK
+    :param exact: precomputed result of sparse_iter_mat_cosine(mat, top_k=k), computed if None
+    :return: dict of recall@k, average number of candidates and time cost in seconds
+    """
+    start = time.time()
+    if exact is None:
+        exact = sparse_iter_mat_cosine(mat, top_k=k, cast=False)
+    exact_time = time.time() - start
+
+    start = time.time()
+    approx, _ = index.batch_query(mat, k)
+    approx_time = time.time() - start
+
+    hits = sum(len(np.intersect1d(a[a >= 0], e)) for a, e in zip(approx, exact))
+    keys = index._hash(sparse_normalize(csr_matrix(mat)))
+    num_candidates = np.mean([len(index._candidates(keys[:, i])) for i in range(mat.shape[0])])
+    return {
+        'recall@%d' % k: hits / exact.size,
+        'avg_candidates': num_candidates,
+        'exact_time': exact_time,
+        'approx_time': approx_time,
+    }
+# ==================================================================================================================== #
+
+
+def precision_benchmark(num_vec=2000, size=500, density=0.05, repeat=3):
+    """
+    Throughput of mat_cosine and sparse_mat_cosine under different precision policies
+    :param num_vec: number of vectors
+    :param size: size of each vector
+    :param density: density of the sparse matrix
+    :param repeat: number of runs, the best one is kept
+    :return: dict of {function/policy: vectors per second}
+    """
+    policies = {
+        'float16': PrecisionPolicy(storage_dtype=np.float16, compute_dtype=np.float16, accumulate_dtype=np.float16),
+        'compact': COMPACT_PRECISION,
+        'native': NATIVE_PRECISION,
+    }
+    rng = np.random.default_rng(0)
+    mat = rng.random((num_vec, size))
+    sparse_mat = csr_matrix(mat * (rng.random((num_vec, size)) < density))
+
+    ret = {}
+    for name, policy in policies.items():
+        cases = [('mat_cosine', mat_cosine, mat)]
+        if policy.compute_dtype != np.float16:
+            cases.append(('sparse_mat_cosine', sparse_mat_cosine, sparse_mat))
+        for func_name, func, arr in cases:
+            cost = min(_timeit(func, arr, precision=policy) for _ in range(repeat))
+            ret['%s/%s' % (func_name, name)] = num_vec / cost
+    return ret
+
+
+def _timeit(func, *args, **kwargs):
+    start = time.time()
+    func(*args, **kwargs)
+    return time.time() - start
+
+
 def test():
     sp_v1 = np.array([1, 2, 3, 5, 4])
     sp_v2 = np.array([1, 2, 3, 4, 5])
@@ -241,6 +1345,8 @@ def test():
     # print(sp_sparse_cos_ret)
 
     sp_sparse_mat_cosine = sparse_mat_cosine(sp_sparse_mat)
+
+    # print(precision_benchmark())
     # print(sp_sparse_mat_cosine)
     # print(sp_sparse_mat_cosine.dtype)
     # print(sp_sparse_mat_cosine[2][0])
@@ -249,13 +1355,14 @@ def test():
 
 
 def load_test():
-    import pandas as pd
-    from sephora_cn_recommendation_engine.lib.models.matrix import NumpyMatrix, SparseMatrix
-
-    # From csv or npy file
-    sp_df = pd.read_csv("")
-    npy_mat = NumpyMatrix(sp_df, target_key='qty').calculate_matrix()
-    sparse_mat = SparseMatrix(sp_df, target_key='qty').calculate_sparse_matrix()
+    # From csv file, read by chunks
+    sp_df = pd.read_csv("", chunksize=1000000)
+    builder = InteractionMatrixBuilder('user_id', 'op_code', target_key='qty')
+    sparse_mat = builder.fit(sp_df)
+    builder.save('user_op.npz')
+    builder = InteractionMatrixBuilder.load('user_op.npz')
+    sparse_mat = builder.matrix
+    npy_mat = sparse_mat.toarray()
 
 
 if __name__ == '__main__':
@@ -1,7 +1,7 @@
 import numpy as np
 
 
-def to_categorical(y, num_classes=None, dtype='float32'):
+def to_categorical(y, num_classes=None, dtype='float32', encoder=None):
     """
     Borrow from keras.utils.np_utils.to_categorical
 
@@ -14,6 +14,9 @@ def to_categorical(y, num_classes=None, dtype='float32'):
         num_classes: total number of classes.
         dtype: The data type expected by the input, as a string
             (`float32`, `float64`, `int32`...)
+        encoder: fitted mapping.Encoder, y is then a vector of raw
+            values encoded by it, num_classes defaults to the size of
+            its vocabulary and unseen values give all-zero rows.
 
     # Returns
         A binary matrix representation of the input. The classes axis
@@ -37,7 +40,12 @@ def to_categorical(y, num_classes=None, dtype='float32'):
     ```
     """
 
-    y = np.array(y, dtype='int')
+    if encoder is not None:
+        y = np.asarray(y)
+        y = encoder.get_indexer(y.ravel()).reshape(y.shape)
+        num_classes = num_classes or len(encoder)
+    else:
+        y = np.array(y, dtype='int')
     input_shape = y.shape
     if input_shape and input_shape[-1] == 1 and len(input_shape) > 1:
         input_shape = tuple(input_shape[:-1])
@@ -46,7 +54,8 @@ def to_categorical(y, num_classes=None, dtype='float32'):
         num_classes = np.max(y) + 1
     n = y.shape[0]
     categorical = np.zeros((n, num_classes), dtype=dtype)
-    categorical[np.arange(n), y] = 1
+    seen = y >= 0 if encoder is not None else slice(None)
+    categorical[np.arange(n)[seen], y[seen]] = 1
     output_shape = input_shape + (num_classes,)
     categorical = np.reshape(categorical, output_shape)
     return categorical
@@ -2,6 +2,7 @@
 pandas utils, some functions and tools to process pandas.DataFrame and pandas.Series
 """
 
+import numpy as np
 import pandas as pd
 
 
@@ -35,3 +36,110 @@ def df_col_rename(df: pd.DataFrame, colname_dict: dict):
     df=df.rename(columns=colname_dict)
     return df
 
+
+def get_schema(name: str):
+    """
+    Get a dtype schema defined in common.py by name
+    :param name: schema name, e.g. 'ctr_feature' or 'ctr_feature_dtype'
+    :return: {column: data type}
+    """
+    from bds_data_science.lib.common import common
+
+    schema = getattr(common, name, None)
+    if not isinstance(schema, dict):
+        schema = getattr(common, name + '_dtype', None)
+    if not isinstance(schema, dict):
+        raise KeyError('schema %s not found in common.py' % name)
+    return schema
+
+
+def _check_range(series: pd.Series, dtype):
+    """
+    Raise ValueError if the values of a column can not be cast to the integer data type: missing values for a
+    non-nullable integer type, or numbers overflowing it
+    """
+    if not pd.api.types.is_integer_dtype(dtype):
+        return
+    dtype = pd.api.types.pandas_dtype(dtype)
+    nullable = not isinstance(dtype, np.dtype)
+    if not nullable and series.isna().any():
+        raise ValueError('Column %s has missing values which can not be cast to %s, use the nullable %s instead'
+                         % (series.name, dtype, ('UInt' if dtype.kind == 'u' else 'Int') + str(dtype.itemsize * 8)))
+    if not pd.api.types.is_numeric_dtype(series):
+        return
+    info = np.iinfo(dtype.numpy_dtype if nullable else dtype)
+    low, high = series.min(), series.max()
+    if pd.notna(low) and (low < info.min or high > info.max):
+        raise ValueError('Values of column %s in [%s, %s] overflow %s' % (series.name, low, high, dtype))
+
+
+def _infer_dtype(series: pd.Series, categorical_threshold: float):
+    """
+    Smallest safe data type of a column, None to keep it
+    """
+    if pd.api.types.is_bool_dtype(series) or isinstance(series.dtype, pd.CategoricalDtype):
+        return None
+    if pd.api.types.is_integer_dtype(series):
+        if len(series) == 0:
+            return None
+        low, high = series.min(), series.max()
+        candidates = ['uint8', 'uint16', 'uint32', 'uint64'] if low >= 0 else ['int8', 'int16', 'int32', 'int64']
+        for dtype in candidates:
+            info = np.iinfo(dtype)
+            if info.min <= low and high <= info.max:
+                return dtype
+    if pd.api.types.is_float_dtype(series) and series.dtype != np.float32:
+        # Only downcast when no precision is lost
+        values = series.to_numpy()
+        if np.array_equal(values.astype(np.float32), values, equal_nan=True):
+            return 'float32'
+        return None
+    if pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series):
+        if len(series) and series.nunique() / len(series) < categorical_threshold:
+            return 'category'
+    return None
+
+
+def optimize_memory(df: pd.DataFrame, schema: dict or str = None, categorical_threshold=0.5):
+    """
+    Reduce the memory of a DataFrame in one astype pass
+
+    With a schema, e.g. common.ctr_feature_dtype or its name 'ctr_feature', the columns in the schema are cast to
+    their data type, after checking the integer columns do not overflow. Without a schema, the smallest safe data
+    types are inferred: integers are downcast by their range, floats to float32 if lossless, and strings with less
+    than categorical_threshold distinct values per row become categoricals.
+    :param df: DataFrame
+    :param schema: {column: data type} or name of a schema in common.py, 'datetime' is parsed by pd.to_datetime
+    :param categorical_threshold: maximum ratio of distinct values to rows of the categorical strings
+    :return: optimized DataFrame and memory report DataFrame of (column, dtype_before, dtype_after,
+             bytes_before, bytes_after), with a 'total' row
+    """
+    if isinstance(schema, str):
+        schema = get_schema(schema)
+    bytes_before = df.memory_usage(deep=True, index=False)
+    dtypes_before = df.dtypes
+
+    if schema is None:
+        dtypes = {col: _infer_dtype(df[col], categorical_threshold) for col in df.columns}
+        dtypes = {col: dtype for col, dtype in dtypes.items() if dtype is not None}
+    else:
+        dtypes = {col: dtype for col, dtype in schema.items() if col in df.columns}
+        for col, dtype in dtypes.items():
+            if dtype != 'datetime':
+                _check_range(df[col], dtype)
+    datetimes = [col for col, dtype in dtypes.items() if dtype == 'datetime']
+    ret = df.astype({col: dtype for col, dtype in dtypes.items() if dtype != 'datetime'})
+    for col in datetimes:
+        ret[col] = pd.to_datetime(ret[col])
+
+    bytes_after = ret.memory_usage(deep=True, index=False)
+    report = pd.DataFrame({
+        'column': list(df.columns),
+        'dtype_before': [str(x) for x in dtypes_before],
+        'dtype_after': [str(x) for x in ret.dtypes],
+        'bytes_before': bytes_before.to_numpy(),
+        'bytes_after': bytes_after.to_numpy(),
+    })
+    total = pd.DataFrame({'column': ['total'], 'dtype_before': [''], 'dtype_after': [''],
+                          'bytes_before': [bytes_before.sum()], 'bytes_after': [bytes_after.sum()]})
+    return ret, pd.concat([report, total], ignore_index=True)
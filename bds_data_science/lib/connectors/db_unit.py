@@ -5,6 +5,8 @@ import sqlalchemy
 from pyhive import presto
 from sqlalchemy import create_engine
 
+from bds_data_science.lib.common.pandas_utils import optimize_memory
+
 
 class PrestoUnit:
     def __init__(self, username: str, password: str, schema: str = 'default', host: str = 'emra1.harbdata.com',
@@ -43,11 +45,20 @@ class PrestoUnit:
             if q.strip():
                 self._execute_one(q)
 
-    def read_sql(self, query):
+    def read_sql(self, query, schema: dict or str = None, optimize=False):
+        """
+        Read the result of a query
+        :param query: presto query
+        :param schema: {column: data type} or name of a schema in common.py, see pandas_utils.optimize_memory
+        :param optimize: whether to infer the smallest data types when no schema is given
+        :return: pandas data frame
+        """
         query = query.replace('%Y%m%d', '%%Y%%m%%d')
         query = query.replace(';', '')
         conn = self.create_conn_sqlalchemy()
         df = pd.read_sql(query, conn)
+        if schema is not None or optimize:
+            df, _ = optimize_memory(df, schema)
         return df
 
     def to_sql(self, df, name, schema='analyst', if_exists='fail', index=False, **kwargs):
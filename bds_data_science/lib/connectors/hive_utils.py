@@ -4,6 +4,7 @@ from sqlalchemy.engine import create_engine
 from sqlalchemy.pool import NullPool
 
 from bds_data_science.lib.common.df_ops import df_split
+from bds_data_science.lib.common.pandas_utils import optimize_memory
 
 
 class HiveUnit:
@@ -51,11 +52,13 @@ class HiveUnit:
         self.execute("set tez.queue.name = sephora_internal")
         self.execute("drop table if exists %s" % tab_name)
 
-    def get_df_from_db(self, query):
+    def get_df_from_db(self, query, schema: dict or str = None, optimize=False):
         """
         This function is going to read date from data base
 
         :param query: hive query
+        :param schema: {column: data type} or name of a schema in common.py, see pandas_utils.optimize_memory
+        :param optimize: whether to infer the smallest data types when no schema is given
         :return: pandas data frame
         """
         cursor = self.conn.cursor()
@@ -67,6 +70,8 @@ class HiveUnit:
         col_des = [tuple([x[0].split('.')[1] if '.' in x[0] else x[0]] + list(x[1:])) for x in col_des]
         col_name = [col_des[i][0] for i in range(len(col_des))]
         df = pd.DataFrame([list(i) for i in data], columns=col_name)
+        if schema is not None or optimize:
+            df, _ = optimize_memory(df, schema)
         return df
 
     def _get_df_from_db(self, tab_name: str, cols: list or str = "*",
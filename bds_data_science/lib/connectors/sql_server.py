@@ -2,6 +2,7 @@ import pymssql
 import pandas as pd
 from sqlalchemy import create_engine
 
+from bds_data_science.lib.common.pandas_utils import optimize_memory
 
 
 class SQLServerUnit:
@@ -48,11 +49,13 @@ class SQLServerUnit:
         self.execute("drop table if exists %s" % tab_name)
         print('TABLE DROPPED!')
 
-    def get_df_from_db(self, query):
+    def get_df_from_db(self, query, schema: dict or str = None, optimize=False):
         """
         This function is going to read date from data base
 
         :param query: hive query
+        :param schema: {column: data type} or name of a schema in common.py, see pandas_utils.optimize_memory
+        :param optimize: whether to infer the smallest data types when no schema is given
         :return: pandas data frame
         """
         cursor = self.conn.cursor()
@@ -62,6 +65,8 @@ class SQLServerUnit:
         col_des = [tuple([x[0].split('.')[1] if '.' in x[0] else x[0]] + list(x[1:])) for x in col_des]
         col_name = [col_des[i][0] for i in range(len(col_des))]
         ret_df = pd.DataFrame([list(i) for i in data], columns=col_name)
+        if schema is not None or optimize:
+            ret_df, _ = optimize_memory(ret_df, schema)
         return ret_df
 
     def df2db(self, df: pd.DataFrame, tab_name, append=False):